@@ -127,6 +127,7 @@ class MessageConfig(ConfigNode):
     analysis_cooldown: float
     context_num: int
     allow_analyze_self: bool  
+    resume_scan: bool
 
     def __init__(self, data: dict[str, Any]):
         super().__init__(data)
@@ -143,9 +144,49 @@ class MessageConfig(ConfigNode):
         return rounds
 
 
+class StorageConfig(ConfigNode):
+    backend: str
+    redis_url: str
+    key_prefix: str
+    lock_timeout: int
+
+
+class SnapshotConfig(ConfigNode):
+    auto_export: bool
+    replay: bool
+    compress: bool
+    keep_count: int
+
+
+class PrewarmConfig(ConfigNode):
+    enable: bool
+    windows: str
+    rounds: int
+    max_groups: int
+    min_demand: float
+    rate_per_min: int
+    keep_hours: int
+
+
+class BudgetConfig(ConfigNode):
+    daily_tokens: int
+    monthly_tokens: int
+
+
+class DebugConfig(ConfigNode):
+    loop_watchdog: bool
+    loop_lag_threshold_ms: int
+    profile_keep_count: int
+
+
 class PluginConfig(ConfigNode):
     llm: LLMConfig
     message: MessageConfig
+    storage: StorageConfig
+    snapshot: SnapshotConfig
+    budget: BudgetConfig
+    prewarm: PrewarmConfig
+    debug: DebugConfig
     load_builtin_prompt: bool
     entry_storage: list[dict[str, Any]]
 
@@ -159,5 +200,6 @@ class PluginConfig(ConfigNode):
         self.plugin_dir = Path(get_astrbot_plugin_path()) / self._plugin_name
         self.style_dir = self.plugin_dir / "pillowmd_style"
         self.cache_dir = self.data_dir / "cache"
+        self.snapshot_dir = self.data_dir / "snapshots"
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.builtin_prompt_file = self.plugin_dir / "builtin_prompts.yaml"
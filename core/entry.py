@@ -1,5 +1,7 @@
 # config.py
 from __future__ import annotations
+
+import asyncio
 from typing import Any
 
 import yaml
@@ -15,16 +17,46 @@ class EntryService:
         self.entries: list[PromptEntry] = [
             PromptEntry(item) for item in self.cfg.entry_storage
         ]
-        if self.cfg.load_builtin_prompt:
-            self.load_builtin_prompts()
-        logger.debug(f"已注册命令：{[e.command for e in self.entries]}")
+        # 内置提示词在后台预热中合并，合并完成前 ready 未置位
+        self.ready = asyncio.Event()
+        # 内置提示词文件读取完成后置位，此时 builtin_commands 可用
+        self.builtin_loaded = asyncio.Event()
+        self.builtin_commands: set[str] = set()
+
+    async def warmup(self) -> None:
+        """后台合并内置提示词"""
+        try:
+            if self.cfg.load_builtin_prompt:
+                await self.load_builtin_prompts()
+        except Exception as e:
+            logger.error(f"加载内置提示词失败：{e}")
+        finally:
+            self.builtin_loaded.set()
+            self.ready.set()
+
+    async def is_pending(self, command: str) -> bool:
+        """
+        命令是否是尚未合并完成的内置提示词命令
+        - 只有内置提示词文件读取完成前才需要短暂等待，普通消息不等待合并与保存
+        """
+        if self.ready.is_set() or not self.cfg.load_builtin_prompt:
+            return False
+        await self.builtin_loaded.wait()
+        return command in self.builtin_commands and not self.ready.is_set()
 
-    def load_builtin_prompts(self) -> None:
+    def _read_builtin_prompts(self) -> list[dict[str, Any]]:
         with self.cfg.builtin_prompt_file.open("r", encoding="utf-8") as f:
-            data: list[dict[str, Any]] = yaml.safe_load(f) or []
-            self.add_entry(data)
+            return yaml.safe_load(f) or []
+
+    async def load_builtin_prompts(self) -> None:
+        """加载内置提示词（YAML 解析在线程池中执行）"""
+        data = await asyncio.to_thread(self._read_builtin_prompts)
+        self.builtin_commands = {item["command"] for item in data}
+        self.builtin_loaded.set()
+        await self.add_entry(data)
+        logger.debug(f"已注册命令：{[e.command for e in self.entries]}")
 
-    def add_entry(self, data: list[dict[str, Any]]) -> None:
+    async def add_entry(self, data: list[dict[str, Any]]) -> None:
         existed_commands = {e.command for e in self.entries}
         new_items: list[dict[str, Any]] = []
 
@@ -36,7 +68,7 @@ class EntryService:
             self.entries.append(PromptEntry(item))
 
         if new_items:
-            self.cfg.save_config()
+            await asyncio.to_thread(self.cfg.save_config)
             logger.info(f"已加载提示词：{[item['command'] for item in new_items]}")
 
     def get_entry(self, command: str) -> PromptEntry | None:
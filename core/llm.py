@@ -1,13 +1,24 @@
 from __future__ import annotations
 
 import asyncio
+import time
 
 from astrbot.api import logger
 from astrbot.api.star import Context
+from astrbot.core.provider.entities import LLMResponse
 from astrbot.core.provider.provider import Provider
 
 from .config import PluginConfig
-from .model import UserProfile
+from .model import LLMUsage, UserProfile
+from .utils import estimate_tokens
+
+
+class LLMCallError(RuntimeError):
+    """LLM 调用失败，usage 为失败前所有尝试的用量"""
+
+    def __init__(self, message: str, usage: LLMUsage):
+        super().__init__(message)
+        self.usage = usage
 
 
 class LLMService:
@@ -23,30 +34,50 @@ class LLMService:
     # public api
     # =========================
 
-    async def generate_portrait(
+    def build_prompts(
         self,
         texts: list[str],
         profile: UserProfile,
         system_prompt_template: str,
-    ) -> str:
+    ) -> tuple[str, str]:
         """
-        生成用户画像分析文本
+        组装画像请求
+        返回: (system_prompt, prompt)
         """
         system_prompt = system_prompt_template.format(
             nickname=profile.nickname,
             gender=profile.pronoun,
         )
-        prompt = self._build_portrait_prompt(texts, profile)
+        return system_prompt, self._build_portrait_prompt(texts, profile)
 
-        resp = await self._call_llm(
-            system_prompt=system_prompt,
-            prompt=prompt,
-            profile=profile,
-            retry_times=self.cfg.retry_times,
-        )
-        if not resp:
-            raise RuntimeError("LLM 响应为空")
-        return resp
+    async def generate_portrait(
+        self,
+        system_prompt: str,
+        prompt: str,
+        profile: UserProfile,
+    ) -> tuple[str, LLMUsage]:
+        """
+        生成用户画像分析文本
+        返回: (画像文本, 本次画像所有尝试的用量)
+        失败时抛出 LLMCallError，其中带有已发生的用量
+        """
+        provider = self._get_provider()
+        usage = LLMUsage(0, 0, 0.0, self._provider_name(provider), attempts=0)
+        try:
+            resp = await self._call_llm(
+                provider,
+                system_prompt=system_prompt,
+                prompt=prompt,
+                profile=profile,
+                usage=usage,
+                retry_times=self.cfg.retry_times,
+            )
+            content = resp.completion_text
+            if not content:
+                raise RuntimeError("LLM 响应为空")
+        except Exception as e:
+            raise LLMCallError(str(e), usage) from e
+        return content, usage
 
     # =========================
     # prompt builders
@@ -61,7 +92,9 @@ class LLMService:
         
         return (
             f"以下是用户【{profile.nickname}】（在记录中标记为【主角】）在群聊中的历史发言片段。\n"
-            f"片段中包含了【主角】的发言以及前文其他群友（显示为【昵称】）的发言作为上下文背景。\n\n"
+            f"片段中包含了【主角】的发言，以及相关的其他群友（显示为【昵称】）发言作为上下文背景："
+            f"【主角】之前的是被其回复或@的消息（没有关联时为前文），"
+            f"标注“回复主角”的是他人对【主角】的回应。\n\n"
             f"*** 分析要求 ***\n"
             f"1. 请重点根据【主角】的发言内容、针对上下文的反应，分析其性格特点、说话风格和心理状态。\n"
             f"2. 其他人的发言仅供理解语境，**不要**对其他人进行分析。\n"
@@ -87,18 +120,70 @@ class LLMService:
 
         return provider
 
+    @staticmethod
+    def _provider_name(provider: Provider) -> str:
+        try:
+            meta = provider.meta()
+            return f"{meta.id}/{meta.model}" if meta.model else meta.id
+        except Exception:
+            return type(provider).__name__
+
+    def _build_usage(
+        self,
+        resp: LLMResponse,
+        provider: Provider,
+        *,
+        latency: float,
+        prompt_text: str,
+        completion_text: str,
+    ) -> LLMUsage:
+        """优先读取提供商返回的用量，没有时用本地估算"""
+        prompt_tokens = completion_tokens = None
+
+        # 新版 AstrBot: LLMResponse.usage (TokenUsage)
+        usage = getattr(resp, "usage", None)
+        if usage is not None:
+            prompt_tokens = getattr(usage, "input", None)
+            completion_tokens = getattr(usage, "output", None)
+
+        # OpenAI 兼容接口: raw_completion.usage
+        if prompt_tokens is None:
+            raw_usage = getattr(getattr(resp, "raw_completion", None), "usage", None)
+            if raw_usage is not None:
+                prompt_tokens = getattr(raw_usage, "prompt_tokens", None)
+                completion_tokens = getattr(raw_usage, "completion_tokens", None)
+
+        estimated = not isinstance(prompt_tokens, int) or not isinstance(
+            completion_tokens, int
+        )
+        if estimated:
+            prompt_tokens = estimate_tokens(prompt_text)
+            completion_tokens = estimate_tokens(completion_text)
+
+        return LLMUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency=latency,
+            provider=self._provider_name(provider),
+            estimated=estimated,
+        )
+
     async def _call_llm(
         self,
+        provider: Provider,
         *,
         system_prompt: str,
         prompt: str,
         profile: UserProfile,
+        usage: LLMUsage,
         retry_times: int = 0,
-    ) -> str:
-        provider = self._get_provider()
+    ) -> LLMResponse:
+        """调用 LLM，失败时重试；每次尝试的用量都累加到 usage"""
         last_exception: Exception | None = None
+        prompt_text = system_prompt + prompt
 
         for attempt in range(retry_times + 1):
+            started = time.perf_counter()
             try:
                 if attempt > 0:
                     logger.warning(
@@ -109,11 +194,30 @@ class LLMService:
                     system_prompt=system_prompt,
                     prompt=prompt,
                 )
-                return resp.completion_text
+                usage.add(
+                    self._build_usage(
+                        resp,
+                        provider,
+                        latency=time.perf_counter() - started,
+                        prompt_text=prompt_text,
+                        completion_text=resp.completion_text or "",
+                    )
+                )
+                return resp
 
             except Exception as e:
                 last_exception = e
                 logger.error(f"LLM 调用失败（第 {attempt + 1} 次）：{e}")
+                # 失败的请求可能已被提供商计费，按 prompt 估算记入
+                usage.add(
+                    LLMUsage(
+                        prompt_tokens=estimate_tokens(prompt_text),
+                        completion_tokens=0,
+                        latency=time.perf_counter() - started,
+                        provider=usage.provider,
+                        estimated=True,
+                    )
+                )
 
                 if attempt >= retry_times:
                     break
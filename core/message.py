@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import asyncio
-from dataclasses import dataclass
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
 from typing import Any
 
 from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
@@ -9,6 +11,9 @@ from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
 )
 from astrbot.api import logger
 from .config import PluginConfig
+from .profiler import ProfileRun
+from .snapshot import SnapshotStore
+from .storage import StorageBackend
 
 
 @dataclass
@@ -29,18 +34,194 @@ class MessageQueryResult:
         return not self.texts
 
 
+@dataclass
+class ReplyGraph:
+    """
+    消息关系图（下标为按时间排序后的消息位置）
+    - parents: 某条消息回复的消息，其次是它 @ 的人在此之前的最后一条发言
+    - children: 回复了某条消息、或 @ 了其发送者的后续消息
+    - names: user_id → 显示名称，用于渲染 @
+    """
+    parents: dict[int, list[int]] = field(default_factory=dict)
+    children: dict[int, list[int]] = field(default_factory=dict)
+    names: dict[str, str] = field(default_factory=dict)
+
+    def _link(self, parent: int, child: int) -> None:
+        if parent == child or parent in self.parents.get(child, ()):
+            return
+        self.parents.setdefault(child, []).append(parent)
+        self.children.setdefault(parent, []).append(child)
+
+    @classmethod
+    def build(
+        cls,
+        all_messages: list[dict[str, Any]],
+        get_name: Callable[[dict[str, Any]], str],
+    ) -> "ReplyGraph":
+        """单次遍历构建消息ID索引与回复 / @ 关系"""
+        graph = cls()
+        index: dict[str, int] = {}
+        last_by_user: dict[str, int] = {}
+
+        for i, msg in enumerate(all_messages):
+            sender_id = str(msg.get("sender", {}).get("user_id", ""))
+            if sender_id:
+                graph.names.setdefault(sender_id, get_name(msg))
+
+            segments = msg.get("message")
+            if isinstance(segments, list):
+                mentioned: list[int] = []
+                for seg in segments:
+                    seg_type = seg.get("type")
+                    data = seg.get("data") or {}
+                    if seg_type == "reply":
+                        parent = index.get(str(data.get("id")))
+                        if parent is not None:
+                            graph._link(parent, i)
+                    elif seg_type == "at":
+                        parent = last_by_user.get(str(data.get("qq")))
+                        if parent is not None:
+                            mentioned.append(parent)
+                # 回复关系优先于 @ 关系
+                for parent in mentioned:
+                    graph._link(parent, i)
+
+            mid = msg.get("message_id")
+            if mid is not None:
+                index[str(mid)] = i
+            if sender_id:
+                last_by_user[sender_id] = i
+
+        return graph
+
+
+@dataclass
+class ScanCheckpoint:
+    """
+    群历史扫描断点
+    - message_seq: 下一页的翻页游标
+    - head_seq / head_synced: 已拉取的最新一条消息的 seq，以及最近一次同步最新消息的时间
+    - seen_ids: 已拉取的消息ID
+    - page_keys: 已拉取消息的分段存储键，每次保存只追加新拉取的那一段
+    - exhausted: 已翻到群历史的尽头
+    """
+    group_id: str
+    message_seq: int = 0
+    rounds: int = 0
+    messages: list[dict[str, Any]] = field(default_factory=list)
+    exhausted: bool = False
+    updated: float = 0.0
+    head_seq: int = 0
+    head_synced: float = 0.0
+    seen_ids: set[int] = field(default_factory=set)
+    page_keys: list[str] = field(default_factory=list)
+    cache_hits: int = 0
+    # 本次扫描中实际向协议端请求、且带来新消息的页数
+    new_pages: int = 0
+    # messages 中已写入 page_keys 的条数，以及上次保存时的状态
+    saved_count: int = 0
+    saved_state: tuple | None = None
+
+    def state(self) -> tuple:
+        return (
+            self.message_seq,
+            self.rounds,
+            self.exhausted,
+            self.head_seq,
+            self.head_synced,
+            len(self.messages),
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "group_id": self.group_id,
+            "message_seq": self.message_seq,
+            "rounds": self.rounds,
+            "exhausted": self.exhausted,
+            "updated": self.updated,
+            "head_seq": self.head_seq,
+            "head_synced": self.head_synced,
+            "seen_ids": list(self.seen_ids),
+            "page_keys": self.page_keys,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ScanCheckpoint":
+        return cls(
+            group_id=data["group_id"],
+            message_seq=data.get("message_seq", 0),
+            rounds=data.get("rounds", 0),
+            exhausted=data.get("exhausted", False),
+            updated=data.get("updated", 0.0),
+            head_seq=data.get("head_seq", 0),
+            head_synced=data.get("head_synced", 0.0),
+            seen_ids=set(data.get("seen_ids", [])),
+            page_keys=data.get("page_keys", []),
+        )
+
+
 class MessageManager:
     """
     带上下文感知的消息管理器
     """
 
-    def __init__(self, config: PluginConfig):
+    def __init__(self, config: PluginConfig, storage: StorageBackend):
         self.cfg = config.message
+        self.storage = storage
+        self.snapshot_cfg = config.snapshot
+        self.snapshots = SnapshotStore(
+            config.snapshot_dir,
+            compress=self.snapshot_cfg.compress,
+            keep_count=self.snapshot_cfg.keep_count,
+        )
         self.per_page_count = 100 
+        self.fetch_retry_times = 2
+        self.checkpoint_interval = 10
+        # 等待同群其他扫描的最长时间(秒)，超时抛出 LockTimeoutError
+        self.scan_lock_wait = 30
+        self.active_scans = 0
+        # 开启后台预热时，断点需要保留到高峰期
+        prewarm = config.prewarm
+        self.checkpoint_ttl = max(
+            self.cfg.cache_ttl, prewarm.keep_hours * 3600 if prewarm.enable else 0
+        )
+        # 补拉上限不少于预热轮数，避免轮数较少的实时命令丢弃预热结果
+        self.keep_rounds = prewarm.rounds if prewarm.enable else 0
 
     def clear_cache(self):
         pass
 
+    async def _fetch_page(
+        self,
+        bot: Any,
+        group_id: str,
+        message_seq: int,
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """
+        拉取一页历史消息
+        - 最新一页（message_seq=0）始终实时拉取
+        - 更早的分页内容不会变化，命中缓存则直接复用
+        返回: (消息列表, 是否命中缓存)
+        """
+        cache_key = f"page:{group_id}:{message_seq}:{self.per_page_count}"
+        if message_seq:
+            cached = await self.storage.get(cache_key)
+            if cached is not None:
+                return cached, True
+
+        result: dict[str, Any] = await bot.api.call_action(
+            "get_group_msg_history",
+            group_id=group_id,
+            count=self.per_page_count,
+            message_seq=message_seq,
+            reverseOrder=True,
+        )
+        messages = result.get("messages", [])
+
+        if message_seq and messages:
+            await self.storage.set(cache_key, messages, ttl=self.cfg.cache_ttl)
+        return messages, False
+
     def _get_sender_name(self, msg_data: dict[str, Any]) -> str:
         """获取消息发送者的最佳显示名称"""
         sender = msg_data.get("sender", {})
@@ -53,148 +234,509 @@ class MessageManager:
             name = f"用户_{user_id[-4:]}" if user_id else "未知用户"
         return name
 
-    def _extract_text(self, msg_data: dict[str, Any]) -> str:
-        """从消息对象中提取纯文本"""
+    def _extract_text(
+        self,
+        msg_data: dict[str, Any],
+        names: dict[str, str] | None = None,
+    ) -> str:
+        """
+        从消息对象中提取纯文本
+        - at 段渲染为 @昵称（names 中没有时用 QQ 号）
+        - reply 段不输出文本，回复关系由 ReplyGraph 记录
+        """
         if "message" in msg_data and isinstance(msg_data["message"], list):
-            return "".join(
-                seg["data"]["text"] 
-                for seg in msg_data["message"] 
-                if seg.get("type") == "text"
-            ).strip()
+            parts = []
+            for seg in msg_data["message"]:
+                seg_type = seg.get("type")
+                data = seg.get("data") or {}
+                if seg_type == "text":
+                    parts.append(data.get("text", ""))
+                elif seg_type == "at":
+                    qq = str(data.get("qq", ""))
+                    if qq == "all":
+                        parts.append("@全体成员 ")
+                    else:
+                        name = data.get("name") or (names or {}).get(qq) or qq
+                        parts.append(f"@{name} ")
+            return "".join(parts).strip()
         
         if "raw_message" in msg_data:
             return str(msg_data["raw_message"]).strip()
         return ""
 
-    async def get_user_texts(
+    async def _fetch_page_with_retry(
         self,
-        event: AiocqhttpMessageEvent,
-        target_id: str,
+        bot: Any,
+        group_id: str,
+        message_seq: int,
+    ) -> tuple[list[dict[str, Any]], bool]:
+        """拉取一页历史消息，瞬时失败时退避重试"""
+        for attempt in range(self.fetch_retry_times + 1):
+            try:
+                return await self._fetch_page(bot, group_id, message_seq)
+            except Exception as e:
+                if attempt >= self.fetch_retry_times:
+                    raise
+                logger.warning(
+                    f"获取群 {group_id} 消息失败，重试中 ({attempt + 1}/{self.fetch_retry_times})：{e}"
+                )
+                await asyncio.sleep(attempt + 1)
+        return [], False
+
+    async def _load_checkpoint(self, group_id: str) -> ScanCheckpoint:
+        if self.cfg.resume_scan:
+            data = await self.storage.get(f"scan:{group_id}")
+            # 旧版断点把全部消息内联保存，直接重新扫描
+            if data and "messages" not in data:
+                ckpt = ScanCheckpoint.from_dict(data)
+                pages = await asyncio.gather(
+                    *(self.storage.get(key) for key in ckpt.page_keys)
+                )
+                if all(page is not None for page in pages):
+                    for page in pages:
+                        ckpt.messages.extend(page)
+                    ckpt.saved_count = len(ckpt.messages)
+                    ckpt.saved_state = ckpt.state()
+                    return ckpt
+                # 分段比断点先过期，断点已不完整
+                logger.info(f"群 {group_id} 的扫描断点已过期，重新扫描")
+        return ScanCheckpoint(group_id=group_id)
+
+    async def _save_checkpoint(self, ckpt: ScanCheckpoint) -> None:
+        """
+        保存断点
+        - 状态没有变化时不保存，避免反复刷新断点的过期时间
+        - 只把上次保存后新拉取的消息写成一个新分段，断点本身只记录游标、已见消息ID和分段键
+        """
+        if not self.cfg.resume_scan or ckpt.state() == ckpt.saved_state:
+            return
+        new_messages = ckpt.messages[ckpt.saved_count:]
+        if new_messages:
+            key = f"scan:{ckpt.group_id}:page:{len(ckpt.page_keys)}"
+            await self.storage.set(key, new_messages, ttl=self.checkpoint_ttl)
+            ckpt.page_keys.append(key)
+            ckpt.saved_count = len(ckpt.messages)
+        ckpt.updated = time.time()
+        await self.storage.set(
+            f"scan:{ckpt.group_id}", ckpt.to_dict(), ttl=self.checkpoint_ttl
+        )
+        ckpt.saved_state = ckpt.state()
+
+    @staticmethod
+    def _msg_seq(msg: dict[str, Any]) -> int | None:
+        """用于翻页与排序的 seq，缺失时退回 message_id"""
+        seq = msg.get("message_seq")
+        if seq is None:
+            seq = msg.get("message_id")
+        return None if seq is None else int(seq)
+
+    @staticmethod
+    def _merge_page(
+        ckpt: ScanCheckpoint, messages: list[dict[str, Any]]
+    ) -> tuple[int, list[int]]:
+        """
+        把一页消息并入断点
+        返回: (新增条数, 用于翻页的 seq 列表)
+        """
+        batch_added_count = 0
+        cursor_seqs = []
+
+        for msg in messages:
+            mid = msg.get("message_id")
+            if mid is not None:
+                mid_int = int(mid)
+                if mid_int in ckpt.seen_ids:
+                    continue
+                ckpt.seen_ids.add(mid_int)
+                ckpt.messages.append(msg)
+                batch_added_count += 1
+            else:
+                ckpt.messages.append(msg)
+                batch_added_count += 1
+
+            # --- 收集用于翻页的 seq ---
+            seq = MessageManager._msg_seq(msg)
+            if seq is not None:
+                cursor_seqs.append(seq)
+
+        if cursor_seqs:
+            ckpt.head_seq = max(ckpt.head_seq, max(cursor_seqs))
+        return batch_added_count, cursor_seqs
+
+    async def _drop_pages(self, ckpt: ScanCheckpoint) -> None:
+        """丢弃断点已保存的分段，下次保存时按当前 messages 重新写入"""
+        keys, ckpt.page_keys = ckpt.page_keys, []
+        ckpt.saved_count = 0
+        await asyncio.gather(*(self.storage.delete(key) for key in keys))
+
+    async def _top_up(
+        self,
+        bot: Any,
+        ckpt: ScanCheckpoint,
+        max_rounds: int,
+        throttle: Callable[[], Awaitable[bool]] | None,
+    ) -> bool:
+        """
+        断点中的最新消息已过期时，从最新一页往前补拉，直到接上断点已有的消息
+        - 补拉的分页全部拿到后才并入断点，中途失败或让路时断点保持原样，下次再补
+        - 补拉 max_rounds 页（不少于预热轮数）仍未接上时，旧消息已在查询范围之外，
+          丢弃旧消息，从新的最新消息重新开始，避免断点中间出现缺口
+        返回: 是否完成补拉
+        """
+        max_rounds = max(max_rounds, self.keep_rounds)
+        head_seq = ckpt.head_seq
+        message_seq = 0
+        pages: list[tuple[list[dict[str, Any]], bool]] = []
+        joined = False
+
+        while len(pages) < max_rounds:
+            if throttle and not await throttle():
+                return False
+            try:
+                messages, hit = await self._fetch_page_with_retry(
+                    bot, ckpt.group_id, message_seq
+                )
+            except Exception as e:
+                logger.error(f"补拉群 {ckpt.group_id} 最新消息失败: {e}")
+                return False
+            if not messages:
+                joined = True
+                break
+
+            pages.append((messages, hit))
+            seqs = [seq for seq in map(self._msg_seq, messages) if seq is not None]
+            overlapped = any(
+                m.get("message_id") is not None and int(m["message_id"]) in ckpt.seen_ids
+                for m in messages
+            )
+            if not seqs or overlapped or min(seqs) <= head_seq or min(seqs) == message_seq:
+                joined = True
+                break
+            message_seq = min(seqs)
+            if not hit:
+                await asyncio.sleep(0.5)
+
+        if not joined:
+            logger.info(
+                f"群 {ckpt.group_id} 的新消息超过 {max_rounds} 页，丢弃旧断点从最新消息重新开始"
+            )
+            ckpt.messages = []
+            ckpt.seen_ids = set()
+            ckpt.head_seq = 0
+            ckpt.exhausted = False
+            await self._drop_pages(ckpt)
+
+        added = 0
+        for messages, hit in pages:
+            batch_added_count, cursor_seqs = self._merge_page(ckpt, messages)
+            added += batch_added_count
+            if batch_added_count and not hit:
+                ckpt.new_pages += 1
+            if not joined and cursor_seqs:
+                ckpt.message_seq = min(cursor_seqs)
+        if not joined:
+            ckpt.rounds = len(pages)
+
+        ckpt.head_synced = time.time()
+        logger.info(f"群 {ckpt.group_id} 补拉了 {added} 条新消息")
+        return True
+
+    async def live_scan_wanted(self, group_id: str) -> bool:
+        """是否有实时命令在等待扫描该群"""
+        return bool(await self.storage.get(f"scan:wanted:{group_id}"))
+
+    async def scan_history(
+        self,
+        bot: Any,
+        group_id: str,
         *,
         max_rounds: int,
-    ) -> MessageQueryResult:
+        throttle: Callable[[], Awaitable[bool]] | None = None,
+    ) -> ScanCheckpoint:
         """
-        获取指定用户在群内的历史文本消息（包含上下文）
+        分页扫描群历史消息
+        - 游标、已见消息ID会定期写入断点，已拉取的消息按分段增量写入
+        - 中断或失败后再次扫描会从断点继续，而不是从最新消息重新开始
+        - 请求更多轮数时，会接着上次的游标往更早的消息翻
+        - 断点的最新消息超过缓存时长时，先补拉断点之后的新消息
+        - 断点在过期前不裁剪，轮数较少的请求只在提取时取最新的 max_rounds 页
+        - throttle: 每次实际请求协议端前等待，返回 False 时保存断点并提前结束，
+          用于续期扫描锁、后台预热限速和给实时扫描让路
         """
-        group_id = str(event.get_group_id())
-        target_id = str(target_id)
-        
-        all_messages = []
-        seen_ids = set() 
-        message_seq = 0 
+        self.active_scans += 1
+        try:
+            return await self._scan_history(bot, group_id, max_rounds, throttle)
+        finally:
+            self.active_scans -= 1
 
-        logger.info(f"开始获取群 {group_id} 消息，目标用户: {target_id}，计划轮数: {max_rounds}")
+    async def _scan_history(
+        self,
+        bot: Any,
+        group_id: str,
+        max_rounds: int,
+        throttle: Callable[[], Awaitable[bool]] | None,
+    ) -> ScanCheckpoint:
+        ckpt = await self._load_checkpoint(group_id)
+        if ckpt.rounds:
+            logger.info(
+                f"群 {group_id} 从断点继续扫描：已完成 {ckpt.rounds} 轮，"
+                f"已拉取 {len(ckpt.messages)} 条消息"
+            )
+            if time.time() - ckpt.head_synced > self.cfg.cache_ttl:
+                if not await self._top_up(bot, ckpt, max_rounds, throttle):
+                    # 补拉失败或需要让路，断点没有变化，直接用已有消息
+                    return ckpt
+        else:
+            ckpt.head_synced = time.time()
+
+        cache_hits = 0
+        dirty_rounds = 0
 
         # ---------- 1. 分页拉取逻辑 ----------
-        for round_idx in range(max_rounds):
+        while not ckpt.exhausted and ckpt.rounds < max_rounds:
+            if throttle and not await throttle():
+                break
             try:
-                if round_idx > 0:
-                    await asyncio.sleep(0.5)
-
-                params = {
-                    "group_id": group_id,
-                    "count": self.per_page_count, 
-                    "message_seq": message_seq,
-                }
-                params["reverseOrder"] = True
-
-                result: dict[str, Any] = await event.bot.api.call_action(
-                    "get_group_msg_history",
-                    **params
+                messages, hit = await self._fetch_page_with_retry(
+                    bot, group_id, ckpt.message_seq
                 )
+            except Exception as e:
+                logger.error(f"获取群消息历史失败 (Round {ckpt.rounds})，已保存断点: {e}")
+                break
 
-                messages = result.get("messages", [])
-                if not messages:
-                    break
-                
-                batch_added_count = 0
-                cursor_seqs = []
-                
-                for msg in messages:
-                    mid = msg.get("message_id")
-                    if mid is not None:
-                        mid_int = int(mid)
-                        if mid_int in seen_ids:
-                            continue
-                        seen_ids.add(mid_int)
-                        all_messages.append(msg)
-                        batch_added_count += 1
-                    else:
-                        all_messages.append(msg)
-                        batch_added_count += 1
-
-                    # --- 2. 收集用于翻页的 seq ---
-                    seq = msg.get("message_seq")
-                    if seq is None:
-                        seq = msg.get("message_id")
-                    
-                    if seq is not None:
-                        cursor_seqs.append(int(seq))
-                
-                if not cursor_seqs:
-                    break 
+            if hit:
+                cache_hits += 1
+            elif ckpt.rounds > 0:
+                await asyncio.sleep(0.5)
 
-                min_seq = min(cursor_seqs) 
-                
-                if min_seq == message_seq and round_idx > 0:
-                    break
-                
-                if batch_added_count == 0 and round_idx > 0:
-                    break
+            if not messages:
+                ckpt.exhausted = True
+                break
 
-                message_seq = min_seq
+            batch_added_count, cursor_seqs = self._merge_page(ckpt, messages)
+            if batch_added_count and not hit:
+                ckpt.new_pages += 1
 
-                if len(all_messages) > max_rounds * self.per_page_count * 1.5:
-                    break
+            if not cursor_seqs:
+                ckpt.exhausted = True
+                break
 
-            except Exception as e:
-                logger.error(f"获取群消息历史失败 (Round {round_idx}): {e}")
+            min_seq = min(cursor_seqs)
+
+            if min_seq == ckpt.message_seq and ckpt.rounds > 0:
+                ckpt.exhausted = True
                 break
 
-        if not all_messages:
-            return MessageQueryResult([], 0, False)
+            if batch_added_count == 0 and ckpt.rounds > 0:
+                ckpt.exhausted = True
+                break
+
+            ckpt.message_seq = min_seq
+            ckpt.rounds += 1
+            dirty_rounds += 1
+
+            if dirty_rounds >= self.checkpoint_interval:
+                await self._save_checkpoint(ckpt)
+                dirty_rounds = 0
+
+            if len(ckpt.messages) > max_rounds * self.per_page_count * 1.5:
+                break
 
-        # ---------- 2. 预处理与排序 ----------
-        all_messages.sort(key=lambda x: int(x.get("time", 0)))
+        await self._save_checkpoint(ckpt)
+        ckpt.cache_hits = cache_hits
+        return ckpt
 
+    async def _replay_snapshot(self, group_id: str) -> ScanCheckpoint | None:
+        """回放模式下，从该群最新的快照读取历史消息"""
+        if not self.snapshot_cfg.replay:
+            return None
+        path = self.snapshots.latest(group_id)
+        if path is None:
+            return None
+        try:
+            messages = await asyncio.to_thread(self.snapshots.load, path)
+        except Exception as e:
+            logger.error(f"读取历史快照失败 {path.name}: {e}")
+            return None
+        logger.info(f"从快照 {path.name} 回放群 {group_id} 的 {len(messages)} 条消息")
+        return ScanCheckpoint(group_id=group_id, messages=messages, exhausted=True)
+
+    async def _export_snapshot(
+        self, group_id: str, messages: list[dict[str, Any]]
+    ) -> None:
+        """扫描完成后导出历史快照"""
+        if not self.snapshot_cfg.auto_export or not messages:
+            return
+        try:
+            path = await asyncio.to_thread(self.snapshots.export, group_id, messages)
+            logger.info(f"已导出群 {group_id} 的历史快照：{path.name}")
+        except Exception as e:
+            logger.error(f"导出历史快照失败: {e}")
+
+    def _window(
+        self, messages: list[dict[str, Any]], max_rounds: int
+    ) -> list[dict[str, Any]]:
+        """
+        只取最新的 max_rounds 页消息
+        断点里可能有补拉或预热得到的更多消息，不能让它们扩大本次查询的范围
+        """
+        limit = max_rounds * self.per_page_count
+        if len(messages) <= limit:
+            return messages
+        ordered = sorted(messages, key=lambda m: self._msg_seq(m) or 0)
+        return ordered[-limit:]
+
+    def _build_fragments(
+        self,
+        messages: list[dict[str, Any]],
+        target_id: str,
+        max_count: int,
+        max_rounds: int,
+    ) -> list[str]:
+        # ---------- 2. 截取查询范围，预处理与排序 ----------
+        messages = self._window(messages, max_rounds)
+        all_messages = sorted(
+            messages,
+            key=lambda x: (int(x.get("time", 0)), self._msg_seq(x) or 0),
+        )
+
+        # ---------- 3. 构建回复 / @ 关系图 ----------
+        graph = ReplyGraph.build(all_messages, self._get_sender_name)
+
+        # ---------- 4. 提取对话片段 ----------
+        return self._extract_fragments(all_messages, graph, target_id, max_count)
+
+    def _format_context(
+        self,
+        msg: dict[str, Any],
+        graph: ReplyGraph,
+        target_id: str,
+        label: str = "",
+    ) -> str | None:
+        text = self._extract_text(msg, graph.names)
+        if not text:
+            return None
+        if len(text) > 50:
+            text = text[:50] + "..."
+        sender_id = str(msg.get("sender", {}).get("user_id", ""))
+        name = "主角" if sender_id == target_id else self._get_sender_name(msg)
+        return f"【{name}】{label}: {text}"
+
+    def _extract_fragments(
+        self,
+        all_messages: list[dict[str, Any]],
+        graph: ReplyGraph,
+        target_id: str,
+        max_count: int,
+    ) -> list[str]:
+        """
+        从按时间排序的消息中提取目标用户的对话片段
+        - 优先使用关联消息作为上下文：它回复/@ 的消息在前，回复/@ 它的消息在后
+        - 没有任何关联时，退回取前 context_num 条消息
+        """
         valid_entries = []
         context_window = self.cfg.context_num
 
-        # ---------- 3. 提取对话片段 ----------
         for i, msg in enumerate(all_messages):
             sender_info = msg.get("sender", {})
             sender_id = str(sender_info.get("user_id", ""))
             
             if sender_id == target_id:
-                raw_text = self._extract_text(msg)
+                raw_text = self._extract_text(msg, graph.names)
                 if not raw_text: 
                     continue
                 
-                context_lines = []
-                start_index = max(0, i - context_window)
-                
-                for ctx_msg in all_messages[start_index:i]:
-                    c_name = self._get_sender_name(ctx_msg)
-                    c_text = self._extract_text(ctx_msg)
-                    if c_text:
-                        if len(c_text) > 50:
-                            c_text = c_text[:50] + "..."
-                        context_lines.append(f"【{c_name}】: {c_text}")
-                
-                entry_str = ""
-                if context_lines:
-                    entry_str += "\n".join(context_lines) + "\n"
-                
-                entry_str += f"【主角】: {raw_text}"
-                
-                valid_entries.append(entry_str)
+                parents = graph.parents.get(i, [])[:context_window]
+                children = graph.children.get(i, [])[: context_window - len(parents)]
+
+                before_lines: list[str] = []
+                after_lines: list[str] = []
 
-                if len(valid_entries) >= self.cfg.max_msg_count:
+                if parents or children:
+                    for p in parents:
+                        line = self._format_context(all_messages[p], graph, target_id)
+                        if line:
+                            before_lines.append(line)
+                    for c in children:
+                        line = self._format_context(
+                            all_messages[c], graph, target_id, "回复主角"
+                        )
+                        if line:
+                            after_lines.append(line)
+                else:
+                    start_index = max(0, i - context_window)
+                    for ctx_msg in all_messages[start_index:i]:
+                        line = self._format_context(ctx_msg, graph, target_id)
+                        if line:
+                            before_lines.append(line)
+
+                lines = [*before_lines, f"【主角】: {raw_text}", *after_lines]
+                valid_entries.append("\n".join(lines))
+
+                if len(valid_entries) >= max_count:
                     break
 
+        return valid_entries
+
+    async def get_user_texts(
+        self,
+        event: AiocqhttpMessageEvent,
+        target_id: str,
+        *,
+        max_rounds: int,
+        max_count: int | None = None,
+        run: ProfileRun | None = None,
+    ) -> MessageQueryResult:
+        """
+        获取指定用户在群内的历史文本消息（包含上下文）
+        - max_count: 对话片段上限，默认取配置 max_msg_count
+        - run: 记录 scan / extract 阶段耗时，被采样时统计线程池里的提取
+        """
+        group_id = str(event.get_group_id())
+        target_id = str(target_id)
+        run = run or ProfileRun(group_id, target_id)
+
+        logger.info(f"开始获取群 {group_id} 消息，目标用户: {target_id}，计划轮数: {max_rounds}")
+
+        with run.stage("scan"):
+            ckpt = await self._replay_snapshot(group_id)
+            if ckpt is None:
+                # 告知正在扫描该群的后台预热尽快让出扫描锁
+                await self.storage.set(
+                    f"scan:wanted:{group_id}", True, ttl=self.scan_lock_wait
+                )
+                # 同一个群的扫描共用断点，同一时间只允许一个扫描推进游标
+                # 扫描耗时随轮数增长，每拉一页续期一次锁
+                async with self.storage.lock(
+                    f"scan:{group_id}", timeout=self.scan_lock_wait
+                ) as scan_lock:
+                    ckpt = await self.scan_history(
+                        event.bot,
+                        group_id,
+                        max_rounds=max_rounds,
+                        throttle=scan_lock.renew,
+                    )
+                # 没有拉到新消息时快照与上次导出的相同，不重复导出
+                if ckpt.new_pages:
+                    await self._export_snapshot(group_id, ckpt.messages)
+
+        if not ckpt.messages:
+            return MessageQueryResult([], 0, ckpt.cache_hits > 0)
+
+        # 数万条消息的排序和提取是 CPU 密集操作，放到线程池避免卡住事件循环
+        with run.stage("extract"):
+            valid_entries = await asyncio.to_thread(
+                run.call,
+                self._build_fragments,
+                ckpt.messages,
+                target_id,
+                max_count or self.cfg.max_msg_count,
+                max_rounds,
+            )
+
+        scanned = min(len(ckpt.messages), max_rounds * self.per_page_count)
         return MessageQueryResult(
             texts=valid_entries,
-            scanned_messages=len(all_messages),
-            from_cache=False,
+            scanned_messages=scanned,
+            from_cache=ckpt.cache_hits > 0,
         )
-        
\ No newline at end of file
@@ -34,3 +34,34 @@ class UserProfile:
     def from_dict(cls, data: Dict[str, Any]) -> "UserProfile":
         """从数据库记录恢复"""
         return cls(**data)
+
+
+@dataclass(slots=True)
+class LLMUsage:
+    """
+    一次画像的 LLM 用量，包含所有重试尝试
+    - estimated 为 True 表示至少有一次尝试提供商未返回用量，token 数含本地估算
+    - attempts 为实际发起的调用次数
+    """
+
+    prompt_tokens: int
+    completion_tokens: int
+    latency: float
+    provider: str
+    estimated: bool = False
+    attempts: int = 1
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "LLMUsage") -> None:
+        """累加一次尝试的用量"""
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.latency += other.latency
+        self.estimated = self.estimated or other.estimated
+        self.attempts += other.attempts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
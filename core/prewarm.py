@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+from typing import Any
+
+from astrbot.api import logger
+
+from .config import PluginConfig
+from .message import MessageManager
+from .storage import HeldLock, LockTimeoutError, StorageBackend
+
+
+class RateLimiter:
+    """按固定间隔放行请求的简单限速器"""
+
+    def __init__(self, rate_per_min: int):
+        self.interval = 60 / max(1, rate_per_min)
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(
+        self,
+        cancel: Callable[[], Awaitable[bool]] | None = None,
+        poll: float = 1,
+    ) -> bool:
+        """
+        等到下一个放行时刻
+        - 低速率下一次要等上几十秒，期间每 poll 秒检查一次 cancel，
+          返回 True 时放弃等待，不占用放行名额
+        返回: 是否放行
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._next <= now:
+                    break
+                if cancel and await cancel():
+                    return False
+                await asyncio.sleep(min(poll, self._next - now))
+            self._next = now + self.interval
+            return True
+
+
+class PrewarmScheduler:
+    """
+    高频群历史消息的后台预热
+    - 每次画像命令为该群记录一次需求，需求分按半衰期衰减
+    - 在配置的低峰时段，按需求分从高到低预先扫描群历史，写入扫描断点
+    - 高峰期的命令直接从断点续查，只需补拉少量新消息
+    - 预热请求受全局限速约束，且在有实时扫描时让路；
+      有实时命令在等待同一个群的扫描锁时，预热保存断点并立即释放锁
+    """
+
+    DEMAND_KEY = "demand:groups"
+    HALF_LIFE = 3 * 86400
+    # 长期没有画像命令时整张需求表过期，此时各群需求分已衰减到千分之一
+    DEMAND_TTL = 10 * HALF_LIFE
+    CHECK_INTERVAL = 300
+
+    def __init__(self, config: PluginConfig, storage: StorageBackend, msg: MessageManager):
+        self.cfg = config.prewarm
+        self.storage = storage
+        self.msg = msg
+        self.limiter = RateLimiter(self.cfg.rate_per_min)
+        self.windows = self._parse_windows(self.cfg.windows)
+        self._bot: Any = None
+        self._task: asyncio.Task | None = None
+
+    # =========================
+    # demand
+    # =========================
+
+    def _decay(self, score: float, updated: float, now: float) -> float:
+        return score * 0.5 ** ((now - updated) / self.HALF_LIFE)
+
+    def _is_cold(self, item: dict[str, Any], now: float) -> bool:
+        """需求分低于预热门槛且闲置超过一个半衰期的群不再记录"""
+        return (
+            now - item["updated"] > self.HALF_LIFE
+            and self._decay(item["score"], item["updated"], now) < self.cfg.min_demand
+        )
+
+    async def record_demand(self, bot: Any, group_id: str) -> None:
+        """记录一次画像需求，顺带清理冷群"""
+        if not self.cfg.enable:
+            return
+        self._bot = bot
+        now = time.time()
+        try:
+            async with self.storage.lock(self.DEMAND_KEY, ttl=10, timeout=10):
+                demand: dict[str, Any] = await self.storage.get(self.DEMAND_KEY) or {}
+                demand = {g: v for g, v in demand.items() if not self._is_cold(v, now)}
+                item = demand.setdefault(str(group_id), {"score": 0.0, "updated": now})
+                item["score"] = self._decay(item["score"], item["updated"], now) + 1
+                item["updated"] = now
+                await self.storage.set(self.DEMAND_KEY, demand, ttl=self.DEMAND_TTL)
+        except Exception as e:
+            logger.error(f"记录画像需求失败：{e}")
+
+    async def hot_groups(self) -> list[tuple[str, float]]:
+        """需求分达标的群，按需求分从高到低"""
+        demand: dict[str, Any] = await self.storage.get(self.DEMAND_KEY) or {}
+        now = time.time()
+        scored = [
+            (group_id, self._decay(item["score"], item["updated"], now))
+            for group_id, item in demand.items()
+        ]
+        hot = [x for x in scored if x[1] >= self.cfg.min_demand]
+        hot.sort(key=lambda x: x[1], reverse=True)
+        return hot[: self.cfg.max_groups]
+
+    # =========================
+    # schedule
+    # =========================
+
+    @staticmethod
+    def _parse_windows(text: str) -> list[tuple[int, int]]:
+        """解析 "02:00-07:00,13:00-14:00"，返回以分钟计的区间"""
+        windows = []
+        for part in (text or "").replace("，", ",").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                start, end = (
+                    int(h) * 60 + int(m)
+                    for h, m in (t.strip().split(":") for t in part.split("-"))
+                )
+            except ValueError:
+                logger.warning(f"无法解析预热时段：{part}")
+                continue
+            windows.append((start, end))
+        return windows
+
+    def in_window(self, now: datetime | None = None) -> bool:
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):  # 跨零点
+                return True
+        return False
+
+    def start(self) -> None:
+        if not self.cfg.enable or self._task is not None:
+            return
+        if not self.windows:
+            logger.warning("已开启后台预热，但没有有效的预热时段")
+            return
+        if not self.msg.cfg.resume_scan:
+            logger.warning("后台预热依赖断点续查，请先开启 resume_scan")
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            if self._bot is None or not self.in_window():
+                continue
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"画像后台预热失败：{e}")
+
+    async def _throttle(self, group_id: str, scan_lock: HeldLock) -> bool:
+        """
+        实时扫描优先：有实时扫描时暂停预热，然后按全局速率放行
+        - 等待期间持续检查是否有实时命令在等该群的扫描锁
+        - 放行前续期扫描锁，低速率预热的总耗时远超锁的过期时间
+        返回 False 表示有实时命令在等待该群的扫描锁或扫描锁已丢失，预热应当结束
+        """
+
+        async def wanted() -> bool:
+            return await self.msg.live_scan_wanted(group_id)
+
+        # 预热自身的扫描也计入 active_scans
+        while True:
+            if await wanted() or not await scan_lock.renew():
+                return False
+            if self.msg.active_scans <= 1:
+                break
+            await asyncio.sleep(1)
+        if not await self.limiter.wait(cancel=wanted):
+            return False
+        if await wanted():
+            return False
+        return await scan_lock.renew()
+
+    async def run_once(self) -> None:
+        for group_id, score in await self.hot_groups():
+            if not self.in_window():
+                return
+            done_key = f"prewarm:done:{group_id}"
+            if await self.storage.get(done_key) or await self.msg.live_scan_wanted(group_id):
+                continue
+            logger.info(f"后台预热群 {group_id} 的历史消息（需求分 {score:.1f}）")
+            try:
+                async with self.storage.lock(f"scan:{group_id}", timeout=5) as scan_lock:
+                    ckpt = await self.msg.scan_history(
+                        self._bot,
+                        group_id,
+                        max_rounds=self.cfg.rounds,
+                        throttle=lambda: self._throttle(group_id, scan_lock),
+                    )
+            except LockTimeoutError:
+                # 其他实例或实时命令正在扫描该群，跳过
+                continue
+            if await self.msg.live_scan_wanted(group_id):
+                # 中途给实时命令让路，断点已保存，下次检查时继续
+                logger.info(f"群 {group_id} 预热给实时命令让路，稍后继续")
+                continue
+            # 同一低峰时段内不重复预热
+            await self.storage.set(done_key, True, ttl=self.cfg.keep_hours * 3600 / 2)
+            logger.info(f"群 {group_id} 预热完成，已缓存 {len(ckpt.messages)} 条消息")
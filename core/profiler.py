@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Any, TypeVar
+
+from astrbot.api import logger
+
+T = TypeVar("T")
+
+
+class ProfileRun:
+    """
+    一次画像命令的阶段耗时
+    - 每次命令都会记录，开销可忽略
+    - 只有被采样的命令才会额外写入 cProfile / tracemalloc 结果
+    """
+
+    def __init__(self, group_id: str, target_id: str):
+        self.group_id = group_id
+        self.target_id = target_id
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.sampled = False
+        # 线程池里执行的函数各自的 cProfile 结果，写入时并入主采样
+        self.thread_profiles: list[cProfile.Profile] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def call(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        在 asyncio.to_thread 的工作线程里调用 func
+        事件循环线程上的 cProfile 看不到其他线程，被采样时单独统计
+        """
+        if not self.sampled:
+            return func(*args)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ 的 cProfile 基于 sys.monitoring，主采样已覆盖所有线程
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profiler.disable()
+            self.thread_profiles.append(profiler)
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> str:
+        parts = [f"{k}={v * 1000:.0f}ms" for k, v in self.stages.items()]
+        parts.append(f"total={self.total * 1000:.0f}ms")
+        return ", ".join(parts)
+
+
+class ProfileCapture:
+    """
+    按需性能采样
+    - arm(count, group_id): 接下来 count 次画像命令（可限定群）开启采样
+    - 采样期间 cProfile 统计的是整个事件循环线程，同时运行的其他协程也会计入
+    - 通过 ProfileRun.call 放到线程池的函数单独统计后合并
+    - 同一时间只采样一条命令
+    """
+
+    _ANY_GROUP = "*"
+
+    def __init__(self, output_dir: Path, keep_count: int):
+        self.output_dir = output_dir
+        self.keep_count = keep_count
+        self._armed: dict[str, int] = {}
+        self._active = False
+
+    # =========================
+    # arm / status
+    # =========================
+
+    def arm(self, count: int, group_id: str | None = None) -> None:
+        key = group_id or self._ANY_GROUP
+        if count <= 0:
+            self._armed.pop(key, None)
+        else:
+            self._armed[key] = count
+
+    def disarm(self) -> None:
+        self._armed.clear()
+
+    def status(self) -> str:
+        if not self._armed:
+            return "当前没有待采样的画像命令"
+        lines = [
+            f"{'任意群' if k == self._ANY_GROUP else f'群{k}'}：剩余{v}次"
+            for k, v in self._armed.items()
+        ]
+        return "待采样：\n" + "\n".join(lines)
+
+    def _take(self, group_id: str) -> bool:
+        """消耗一次采样名额"""
+        if self._active:
+            return False
+        for key in (group_id, self._ANY_GROUP):
+            remaining = self._armed.get(key, 0)
+            if remaining > 0:
+                if remaining == 1:
+                    self._armed.pop(key)
+                else:
+                    self._armed[key] = remaining - 1
+                return True
+        return False
+
+    # =========================
+    # capture
+    # =========================
+
+    @asynccontextmanager
+    async def capture(self, group_id: str, target_id: str) -> AsyncIterator[ProfileRun]:
+        run = ProfileRun(str(group_id), str(target_id))
+        if not self._take(run.group_id):
+            yield run
+            return
+
+        self._active = True
+        run.sampled = True
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(25)
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield run
+        finally:
+            profiler.disable()
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            self._active = False
+            try:
+                path = await asyncio.to_thread(
+                    self._write, run, profiler, before, after, peak
+                )
+                logger.info(f"画像性能采样已写入：{path}")
+            except Exception as e:
+                logger.error(f"写入画像性能采样失败：{e}")
+
+    def _write(
+        self,
+        run: ProfileRun,
+        profiler: cProfile.Profile,
+        before: tracemalloc.Snapshot,
+        after: tracemalloc.Snapshot,
+        peak: int,
+    ) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        base = self.output_dir / f"{stamp}_{run.group_id}_{run.target_id}"
+
+        stats_buf = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_buf)
+        for thread_profiler in run.thread_profiles:
+            stats.add(thread_profiler)
+        stats.dump_stats(base.with_suffix(".prof"))
+        stats.sort_stats("cumulative").print_stats(40)
+
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+        diff = after.filter_traces(filters).compare_to(
+            before.filter_traces(filters), "lineno"
+        )
+
+        meta: dict[str, Any] = {
+            "group_id": run.group_id,
+            "target_id": run.target_id,
+            "total_ms": round(run.total * 1000, 1),
+            "stages_ms": {k: round(v * 1000, 1) for k, v in run.stages.items()},
+            "tracemalloc_peak_kb": round(peak / 1024, 1),
+        }
+        base.with_suffix(".json").write_text(
+            json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+
+        report = [
+            f"群 {run.group_id} / 目标 {run.target_id}",
+            f"阶段耗时：{run.summary()}",
+            f"tracemalloc 峰值：{meta['tracemalloc_peak_kb']}KB",
+            "",
+            "=== 内存分配增量 Top 30 ===",
+            *(str(s) for s in diff[:30]),
+            "",
+            "=== cProfile（按累计耗时） ===",
+            stats_buf.getvalue(),
+        ]
+        base.with_suffix(".txt").write_text("\n".join(report), encoding="utf-8")
+
+        self._prune()
+        return base
+
+    def _prune(self) -> None:
+        """只保留最近 keep_count 次采样"""
+        runs = sorted({p.stem for p in self.output_dir.iterdir() if p.is_file()})
+        for stem in runs[: max(0, len(runs) - self.keep_count)]:
+            for p in self.output_dir.glob(f"{stem}.*"):
+                p.unlink(missing_ok=True)
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import gzip
+import json
+import mmap
+import time
+from collections.abc import Generator, Iterator
+from pathlib import Path
+from typing import Any
+
+SNAPSHOT_FORMAT = "portrayal-snapshot"
+SNAPSHOT_VERSION = 1
+
+
+# =========================
+# 文件格式
+# =========================
+# JSON-lines，每行一个 JSON 对象：
+#   第 1 行：文件头 {"format", "version", "group_id", "created", "count"}
+#   之后每行：一条原始 OneBot 消息（与 get_group_msg_history 返回的结构一致）
+# .jsonl.gz 为 gzip 压缩，可流式读写；.jsonl 为明文，读取时使用 mmap
+
+
+def write_snapshot(
+    path: Path,
+    group_id: str,
+    messages: list[dict[str, Any]],
+) -> Path:
+    """
+    写入历史快照，按后缀决定是否压缩
+    - 先写临时文件再替换，避免读到写了一半的快照
+    """
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "group_id": str(group_id),
+        "created": time.time(),
+        "count": len(messages),
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for msg in messages:
+            f.write(json.dumps(msg, ensure_ascii=False, separators=(",", ":")) + "\n")
+    tmp_path.replace(path)
+    return path
+
+
+def _iter_lines(path: Path) -> Generator[bytes, None, None]:
+    if path.suffix == ".gz":
+        with gzip.open(path, "rb") as f:
+            yield from f
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from iter(mm.readline, b"")
+
+
+def _check_header(path: Path, line: bytes) -> dict[str, Any]:
+    header = json.loads(line)
+    if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"不是有效的画像历史快照：{path}")
+    if header.get("version", 0) > SNAPSHOT_VERSION:
+        raise ValueError(f"快照版本过新（{header.get('version')}）：{path}")
+    return header
+
+
+def read_snapshot_header(path: Path) -> dict[str, Any]:
+    """只读取快照文件头"""
+    lines = _iter_lines(path)
+    try:
+        return _check_header(path, next(lines))
+    except StopIteration:
+        raise ValueError(f"快照文件为空：{path}") from None
+    finally:
+        lines.close()
+
+
+def iter_snapshot(path: Path) -> Iterator[dict[str, Any]]:
+    """流式读取快照中的消息，不会一次性载入整个文件"""
+    lines = _iter_lines(path)
+    try:
+        first = next(lines, None)
+        if first is None:
+            raise ValueError(f"快照文件为空：{path}")
+        _check_header(path, first)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        lines.close()
+
+
+class SnapshotStore:
+    """
+    快照目录管理
+    - 文件名：{group_id}_{时间戳}.jsonl[.gz]
+    - 每个群只保留最近 keep_count 份
+    """
+
+    def __init__(self, snapshot_dir: Path, *, compress: bool = True, keep_count: int = 3):
+        self.snapshot_dir = snapshot_dir
+        self.compress = compress
+        self.keep_count = keep_count
+
+    def files(self, group_id: str) -> list[Path]:
+        """按时间从旧到新列出某个群的快照"""
+        if not self.snapshot_dir.exists():
+            return []
+        files = [
+            p
+            for p in self.snapshot_dir.glob(f"{group_id}_*.jsonl*")
+            if not p.name.endswith(".tmp")
+        ]
+        return sorted(files, key=lambda p: p.name.split(".")[0])
+
+    def latest(self, group_id: str) -> Path | None:
+        files = self.files(group_id)
+        return files[-1] if files else None
+
+    def export(self, group_id: str, messages: list[dict[str, Any]]) -> Path:
+        """写入一份新快照，并清理超出保留数量的旧快照"""
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        now = time.time()
+        stamp = time.strftime("%Y%m%d%H%M%S", time.localtime(now))
+        stamp += f"{int(now * 1000) % 1000:03d}"
+        path = write_snapshot(
+            self.snapshot_dir / f"{group_id}_{stamp}{suffix}", group_id, messages
+        )
+        self.prune(group_id)
+        return path
+
+    def prune(self, group_id: str) -> None:
+        files = self.files(group_id)
+        for old in files[: max(0, len(files) - self.keep_count)]:
+            old.unlink(missing_ok=True)
+
+    def load(self, path: Path) -> list[dict[str, Any]]:
+        return list(iter_snapshot(path))
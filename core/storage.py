@@ -0,0 +1,395 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any
+
+from astrbot.api import logger
+
+from .config import PluginConfig
+
+
+class LockTimeoutError(TimeoutError):
+    """等待锁超时"""
+
+
+class HeldLock:
+    """
+    lock() 持有期间的句柄
+    - 持有时间可能超过 ttl 的任务（如逐页扫描）定期调用 renew 续期
+    """
+
+    def __init__(self, storage: StorageBackend, key: str, token: str, ttl: float):
+        self._storage = storage
+        self._key = key
+        self._token = token
+        self.ttl = ttl
+
+    async def renew(self) -> bool:
+        """把锁的过期时间重置为 ttl，锁已过期被他人拿走或续期失败时返回 False"""
+        try:
+            return await self._storage._renew(self._key, self._token, self.ttl)
+        except Exception as e:
+            logger.error(f"锁续期失败 {self._key}: {e}")
+            return False
+
+
+class StorageBackend(ABC):
+    """
+    共享状态存储接口
+    - 冷却记录 / 画像缓存 / 历史分页缓存 都通过它读写
+    - 值统一为可 JSON 序列化的对象
+    - lock() 提供跨节点的 single-flight 互斥
+    """
+
+    def __init__(self, key_prefix: str = ""):
+        self.key_prefix = key_prefix
+
+    def _key(self, key: str) -> str:
+        return f"{self.key_prefix}{key}"
+
+    # =========================
+    # kv
+    # =========================
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None:
+        """读取键值，不存在或已过期返回 None"""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        """写入键值，ttl 单位为秒，None 表示永不过期"""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """删除键值"""
+
+    # =========================
+    # lock
+    # =========================
+
+    @abstractmethod
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        """尝试获取锁，成功返回 True"""
+
+    @abstractmethod
+    async def _release(self, key: str, token: str) -> None:
+        """释放锁（仅当持有者为 token 时）"""
+
+    @abstractmethod
+    async def _renew(self, key: str, token: str, ttl: float) -> bool:
+        """续期锁（仅当持有者为 token 时），成功返回 True"""
+
+    @asynccontextmanager
+    async def lock(
+        self,
+        key: str,
+        *,
+        ttl: float = 600,
+        timeout: float = 600,
+        interval: float = 0.5,
+    ) -> AsyncIterator[HeldLock]:
+        """
+        分布式互斥锁
+        - ttl: 锁的自动过期时间，防止持有者崩溃后死锁
+        - timeout: 等待锁的最长时间，超时抛出 LockTimeoutError
+        - 返回的 HeldLock 可用于续期
+        """
+        lock_key = self._key(f"lock:{key}")
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+
+        while not await self._acquire(lock_key, token, ttl):
+            if time.monotonic() >= deadline:
+                raise LockTimeoutError(f"等待锁超时：{key}")
+            await asyncio.sleep(interval)
+
+        try:
+            yield HeldLock(self, lock_key, token, ttl)
+        finally:
+            try:
+                await self._release(lock_key, token)
+            except Exception as e:
+                logger.error(f"释放锁失败 {key}: {e}")
+
+    async def close(self) -> None:
+        """释放底层连接"""
+
+
+class MemoryStorage(StorageBackend):
+    """
+    进程内存储
+    - 单实例部署 / 本地调试
+    - 也可作为网络 KV 后端的进程内替身
+    """
+
+    # 每写入这么多次清理一遍过期键
+    SWEEP_INTERVAL = 256
+
+    def __init__(self, key_prefix: str = ""):
+        super().__init__(key_prefix)
+        self._data: dict[str, tuple[str, float | None]] = {}
+        self._writes = 0
+
+    def _read(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        raw, expire_at = item
+        if expire_at is not None and expire_at <= time.time():
+            self._data.pop(key, None)
+            return None
+        return raw
+
+    def _write(self, key: str, raw: str, ttl: float | None) -> None:
+        expire_at = time.time() + ttl if ttl else None
+        self._data[key] = (raw, expire_at)
+        self._writes += 1
+        if self._writes >= self.SWEEP_INTERVAL:
+            self._sweep()
+
+    def _sweep(self) -> None:
+        """清理过期键：分页缓存等键过期后很少再被读取，不能只靠读取时删除"""
+        self._writes = 0
+        now = time.time()
+        expired = [
+            k for k, (_, expire_at) in self._data.items()
+            if expire_at is not None and expire_at <= now
+        ]
+        for k in expired:
+            del self._data[k]
+
+    async def get(self, key: str) -> Any | None:
+        raw = self._read(self._key(key))
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self._write(self._key(key), json.dumps(value, ensure_ascii=False), ttl)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(self._key(key), None)
+
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        if self._read(key) is not None:
+            return False
+        self._write(key, token, ttl)
+        return True
+
+    async def _release(self, key: str, token: str) -> None:
+        if self._read(key) == token:
+            self._data.pop(key, None)
+
+    async def _renew(self, key: str, token: str, ttl: float) -> bool:
+        if self._read(key) != token:
+            return False
+        self._write(key, token, ttl)
+        return True
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    本地 SQLite 存储
+    - 同一台机器上的多个实例可共享同一个数据库文件
+    - 所有数据库操作和序列化都在线程池中执行，不阻塞事件循环
+    - 每写入一定次数清理一遍过期行
+    """
+
+    SWEEP_INTERVAL = 256
+
+    def __init__(self, db_file: Path, key_prefix: str = ""):
+        super().__init__(key_prefix)
+        self.db_file = db_file
+        self._conn: sqlite3.Connection | None = None
+        self._conn_lock = threading.Lock()
+        self._writes = 0
+
+    async def _run(self, func, *args):
+        """在线程池中串行执行数据库操作"""
+
+        def call():
+            with self._conn_lock:
+                return func(*args)
+
+        return await asyncio.to_thread(call)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.db_file,
+                timeout=10,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL)"
+            )
+            self._conn = conn
+            self._sweep_sync()
+        return self._conn
+
+    def _sweep_sync(self) -> None:
+        """清理过期行：分页缓存等键过期后很少再被读取，不能只靠读取时忽略"""
+        self._writes = 0
+        self._connect().execute("DELETE FROM kv WHERE expire_at <= ?", (time.time(),))
+
+    def _get_sync(self, key: str) -> Any | None:
+        row = (
+            self._connect()
+            .execute("SELECT value, expire_at FROM kv WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        raw, expire_at = row
+        if expire_at is not None and expire_at <= time.time():
+            return None
+        return json.loads(raw)
+
+    def _set_sync(self, key: str, value: Any, ttl: float | None) -> None:
+        raw = json.dumps(value, ensure_ascii=False)
+        expire_at = time.time() + ttl if ttl else None
+        self._connect().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expire_at) VALUES (?, ?, ?)",
+            (key, raw, expire_at),
+        )
+        self._writes += 1
+        if self._writes >= self.SWEEP_INTERVAL:
+            self._sweep_sync()
+
+    def _delete_sync(self, key: str) -> None:
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _acquire_sync(self, key: str, token: str, ttl: float) -> bool:
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM kv WHERE key = ? AND expire_at <= ?", (key, now)
+            )
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expire_at) VALUES (?, ?, ?)",
+                (key, token, now + ttl),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount == 1
+
+    def _release_sync(self, key: str, token: str) -> None:
+        self._connect().execute(
+            "DELETE FROM kv WHERE key = ? AND value = ?", (key, token)
+        )
+
+    def _renew_sync(self, key: str, token: str, ttl: float) -> bool:
+        now = time.time()
+        cur = self._connect().execute(
+            "UPDATE kv SET expire_at = ? WHERE key = ? AND value = ? AND expire_at > ?",
+            (now + ttl, key, token, now),
+        )
+        return cur.rowcount == 1
+
+    async def get(self, key: str) -> Any | None:
+        return await self._run(self._get_sync, self._key(key))
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        await self._run(self._set_sync, self._key(key), value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self._run(self._delete_sync, self._key(key))
+
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        return await self._run(self._acquire_sync, key, token, ttl)
+
+    async def _release(self, key: str, token: str) -> None:
+        await self._run(self._release_sync, key, token)
+
+    async def _renew(self, key: str, token: str, ttl: float) -> bool:
+        return await self._run(self._renew_sync, key, token, ttl)
+
+    async def close(self) -> None:
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RedisStorage(StorageBackend):
+    """
+    Redis 存储（多机多实例共享）
+    - 依赖 redis>=5 库（redis.asyncio 与 aclose），未安装或版本过低时在创建时报错
+    - 可传入现成的客户端，例如压测时用 fakeredis 作为进程内替身
+    """
+
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+    _RENEW_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    )
+
+    def __init__(self, url: str, key_prefix: str = "", client: Any = None):
+        super().__init__(key_prefix)
+        if client is not None:
+            self._client = client
+            return
+        try:
+            from redis import asyncio as aioredis
+        except ImportError as e:
+            raise RuntimeError("使用 redis 存储后端需要先安装 redis>=5 库") from e
+        if not hasattr(aioredis.Redis, "aclose"):
+            raise RuntimeError("redis 库版本过低，redis 存储后端需要 redis>=5")
+        self._client = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Any | None:
+        raw = await self._client.get(self._key(key))
+        return None if raw is None else await asyncio.to_thread(json.loads, raw)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        raw = await asyncio.to_thread(json.dumps, value, ensure_ascii=False)
+        px = int(ttl * 1000) if ttl else None
+        await self._client.set(self._key(key), raw, px=px)
+
+    async def delete(self, key: str) -> None:
+        await self._client.delete(self._key(key))
+
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        return bool(await self._client.set(key, token, nx=True, px=int(ttl * 1000)))
+
+    async def _release(self, key: str, token: str) -> None:
+        await self._client.eval(self._RELEASE_SCRIPT, 1, key, token)
+
+    async def _renew(self, key: str, token: str, ttl: float) -> bool:
+        return bool(
+            await self._client.eval(self._RENEW_SCRIPT, 1, key, token, int(ttl * 1000))
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def create_storage(config: PluginConfig) -> StorageBackend:
+    """根据配置创建存储后端"""
+    cfg = config.storage
+    prefix = cfg.key_prefix or ""
+
+    if cfg.backend == "redis":
+        logger.info(f"画像插件使用 redis 存储后端：{cfg.redis_url}")
+        return RedisStorage(cfg.redis_url, prefix)
+    if cfg.backend == "memory":
+        return MemoryStorage(prefix)
+    return SQLiteStorage(config.data_dir / "storage.db", prefix)
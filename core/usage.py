@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+from astrbot.api import logger
+
+from .config import PluginConfig
+from .model import LLMUsage
+from .storage import StorageBackend
+
+
+@dataclass
+class BudgetPlan:
+    """
+    预算规划结果
+    - allowed 为 False 时 reason 为拒绝原因
+    - shrunk 为 True 时 rounds / max_count 已按剩余预算缩减
+    - reservation 为预留额度的ID，调用结束后由 record / release 结算
+    """
+
+    allowed: bool
+    rounds: int
+    max_count: int
+    shrunk: bool = False
+    reason: str = ""
+    reservation: str = ""
+
+
+class UsageService:
+    """
+    LLM 用量统计与按群预算
+    - 按 群 × 天 / 群 × 月 累计调用次数、token 数、耗时，并细分到发起人
+    - 预算不足时自动缩减查询轮数与对话片段数，耗尽时拒绝
+    - 规划时按估算预留额度，调用结束后按实际用量结算，避免并发画像超支
+    """
+
+    # 没有历史数据时，每个对话片段（含上下文）的 token 估算值
+    DEFAULT_TOKENS_PER_FRAGMENT = 80
+    # 画像输出的 token 预留
+    COMPLETION_RESERVE = 1500
+    # 少于这么多片段时画像没有意义，直接拒绝
+    MIN_FRAGMENTS = 10
+    RECENT_CALLS = 20
+    # 预留额度的有效期，防止实例崩溃后额度一直被占用
+    RESERVATION_TTL = 600
+
+    def __init__(self, config: PluginConfig, storage: StorageBackend):
+        self.cfg = config.budget
+        self.storage = storage
+
+    # =========================
+    # buckets
+    # =========================
+
+    @staticmethod
+    def _day_key(group_id: str, now: float) -> str:
+        return f"usage:{group_id}:day:{time.strftime('%Y%m%d', time.localtime(now))}"
+
+    @staticmethod
+    def _month_key(group_id: str, now: float) -> str:
+        return f"usage:{group_id}:month:{time.strftime('%Y%m', time.localtime(now))}"
+
+    @staticmethod
+    def _reserved_key(group_id: str) -> str:
+        return f"usage:{group_id}:reserved"
+
+    @staticmethod
+    def _empty_bucket() -> dict[str, Any]:
+        return {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "fragments": 0,
+            "latency": 0.0,
+            "estimated_calls": 0,
+            "users": {},
+            "recent": [],
+        }
+
+    async def _load(self, key: str) -> dict[str, Any]:
+        return await self.storage.get(key) or self._empty_bucket()
+
+    @staticmethod
+    def _total(bucket: dict[str, Any]) -> int:
+        return bucket["prompt_tokens"] + bucket["completion_tokens"]
+
+    async def _load_reserved(self, group_id: str) -> dict[str, dict[str, float]]:
+        reserved: dict[str, dict[str, float]] = (
+            await self.storage.get(self._reserved_key(group_id)) or {}
+        )
+        now = time.time()
+        return {k: v for k, v in reserved.items() if v["expires"] > now}
+
+    async def _save_reserved(
+        self, group_id: str, reserved: dict[str, dict[str, float]]
+    ) -> None:
+        if reserved:
+            await self.storage.set(
+                self._reserved_key(group_id), reserved, ttl=self.RESERVATION_TTL
+            )
+        else:
+            await self.storage.delete(self._reserved_key(group_id))
+
+    # =========================
+    # record
+    # =========================
+
+    async def record(
+        self,
+        group_id: str,
+        user_id: str,
+        target_id: str,
+        usage: LLMUsage,
+        fragments: int,
+        reservation: str = "",
+    ) -> None:
+        """记录一次画像调用的用量（含失败的尝试），并结算预留额度"""
+        group_id = str(group_id)
+        now = time.time()
+        call = {
+            "time": now,
+            "user_id": str(user_id),
+            "target_id": str(target_id),
+            "fragments": fragments,
+            **usage.to_dict(),
+        }
+
+        try:
+            async with self.storage.lock(f"usage:{group_id}", ttl=30, timeout=30):
+                for key, ttl in (
+                    (self._day_key(group_id, now), 40 * 86400),
+                    (self._month_key(group_id, now), 400 * 86400),
+                ):
+                    bucket = await self._load(key)
+                    bucket["calls"] += 1
+                    bucket["prompt_tokens"] += usage.prompt_tokens
+                    bucket["completion_tokens"] += usage.completion_tokens
+                    bucket["fragments"] += fragments
+                    bucket["latency"] += usage.latency
+                    bucket["estimated_calls"] += int(usage.estimated)
+                    users = bucket["users"]
+                    users[str(user_id)] = users.get(str(user_id), 0) + usage.total_tokens
+                    bucket["recent"] = (bucket["recent"] + [call])[-self.RECENT_CALLS:]
+                    await self.storage.set(key, bucket, ttl=ttl)
+                if reservation:
+                    reserved = await self._load_reserved(group_id)
+                    reserved.pop(reservation, None)
+                    await self._save_reserved(group_id, reserved)
+        except Exception as e:
+            logger.error(f"记录LLM用量失败：{e}")
+            return
+
+        logger.info(
+            f"画像用量（群{group_id}）：prompt {usage.prompt_tokens} + completion "
+            f"{usage.completion_tokens} tokens"
+            f"{'（估算）' if usage.estimated else ''}，耗时 {usage.latency:.1f}s，"
+            f"尝试 {usage.attempts} 次，提供商 {usage.provider}"
+        )
+
+    async def release(self, group_id: str, reservation: str) -> None:
+        """释放未使用的预留额度（已由 record 结算的预留不受影响）"""
+        if not reservation:
+            return
+        group_id = str(group_id)
+        try:
+            async with self.storage.lock(f"usage:{group_id}", ttl=30, timeout=30):
+                reserved = await self._load_reserved(group_id)
+                if reserved.pop(reservation, None) is not None:
+                    await self._save_reserved(group_id, reserved)
+        except Exception as e:
+            logger.error(f"释放画像预算预留失败：{e}")
+
+    # =========================
+    # budget
+    # =========================
+
+    async def remaining(self, group_id: str) -> int | None:
+        """剩余预算（token，已扣除进行中的预留），None 表示不限"""
+        now = time.time()
+        limits: list[int] = []
+        if self.cfg.daily_tokens > 0:
+            day = await self._load(self._day_key(str(group_id), now))
+            limits.append(self.cfg.daily_tokens - self._total(day))
+        if self.cfg.monthly_tokens > 0:
+            month = await self._load(self._month_key(str(group_id), now))
+            limits.append(self.cfg.monthly_tokens - self._total(month))
+        if not limits:
+            return None
+        reserved = await self._load_reserved(str(group_id))
+        return min(limits) - int(sum(r["tokens"] for r in reserved.values()))
+
+    async def _tokens_per_fragment(self, group_id: str) -> float:
+        """用本月历史数据估算每个片段的 prompt token 数"""
+        month = await self._load(self._month_key(str(group_id), time.time()))
+        if month["fragments"] > 0:
+            return month["prompt_tokens"] / month["fragments"]
+        return self.DEFAULT_TOKENS_PER_FRAGMENT
+
+    async def plan(self, group_id: str, rounds: int, max_count: int) -> BudgetPlan:
+        """
+        根据剩余预算决定本次画像的查询轮数与片段上限
+        - 有预算限制时按片段上限预留额度，调用结束后需 record 或 release
+        """
+        if self.cfg.daily_tokens <= 0 and self.cfg.monthly_tokens <= 0:
+            return BudgetPlan(True, rounds, max_count)
+
+        group_id = str(group_id)
+        try:
+            async with self.storage.lock(f"usage:{group_id}", ttl=30, timeout=30):
+                return await self._plan_locked(group_id, rounds, max_count)
+        except Exception as e:
+            logger.error(f"画像预算规划失败：{e}")
+            return BudgetPlan(
+                False, rounds, max_count, reason="画像预算检查失败，请稍后再试"
+            )
+
+    async def _plan_locked(self, group_id: str, rounds: int, max_count: int) -> BudgetPlan:
+        remaining = await self.remaining(group_id) or 0
+        if remaining <= 0:
+            return BudgetPlan(
+                False, rounds, max_count, reason="本群的画像预算已用完，请等预算重置后再试"
+            )
+
+        per_fragment = await self._tokens_per_fragment(group_id)
+        affordable = int((remaining - self.COMPLETION_RESERVE) / per_fragment)
+        if affordable >= max_count:
+            plan = BudgetPlan(True, rounds, max_count)
+        elif affordable < self.MIN_FRAGMENTS:
+            return BudgetPlan(
+                False,
+                rounds,
+                max_count,
+                reason=f"本群剩余画像预算仅{remaining} tokens，不足以完成一次画像",
+            )
+        else:
+            ratio = affordable / max_count
+            plan = BudgetPlan(
+                True,
+                rounds=max(1, int(rounds * ratio)),
+                max_count=affordable,
+                shrunk=True,
+            )
+
+        plan.reservation = uuid.uuid4().hex
+        reserved = await self._load_reserved(group_id)
+        reserved[plan.reservation] = {
+            "tokens": int(plan.max_count * per_fragment) + self.COMPLETION_RESERVE,
+            "expires": time.time() + self.RESERVATION_TTL,
+        }
+        await self._save_reserved(group_id, reserved)
+        return plan
+
+    # =========================
+    # report
+    # =========================
+
+    def _format_bucket(self, title: str, bucket: dict[str, Any], limit: int) -> list[str]:
+        total = self._total(bucket)
+        lines = [
+            f"### {title}",
+            f"- 调用次数：{bucket['calls']}"
+            + (f"（其中{bucket['estimated_calls']}次为估算）" if bucket["estimated_calls"] else ""),
+            f"- Token：{total}（prompt {bucket['prompt_tokens']} / completion {bucket['completion_tokens']}）",
+            f"- 预算：{f'{total}/{limit}' if limit > 0 else '不限'}",
+        ]
+        if bucket["calls"]:
+            lines.append(f"- 平均耗时：{bucket['latency'] / bucket['calls']:.1f}s")
+        top_users = sorted(bucket["users"].items(), key=lambda x: x[1], reverse=True)[:5]
+        if top_users:
+            lines.append("- 用量最多的发起人：")
+            lines.extend(f"  - {uid}：{tokens}" for uid, tokens in top_users)
+        return lines
+
+    async def report(self, group_id: str) -> str:
+        now = time.time()
+        day = await self._load(self._day_key(str(group_id), now))
+        month = await self._load(self._month_key(str(group_id), now))
+        reserved = await self._load_reserved(str(group_id))
+        lines = [
+            f"## 群{group_id} 画像用量",
+            "",
+            *self._format_bucket("今日", day, self.cfg.daily_tokens),
+            "",
+            *self._format_bucket("本月", month, self.cfg.monthly_tokens),
+        ]
+        if reserved:
+            tokens = int(sum(r["tokens"] for r in reserved.values()))
+            lines += ["", f"- 进行中的画像：{len(reserved)}个，预留 {tokens} tokens"]
+        return "\n".join(lines)
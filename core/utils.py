@@ -12,3 +12,9 @@ def get_at_id(event: AiocqhttpMessageEvent) -> str | None:
         ),
         None,
     )
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个计，其余字符按 4 个折 1 个"""
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+    return cjk + (len(text) - cjk + 3) // 4
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from astrbot.api import logger
+
+
+class LoopWatchdog:
+    """
+    事件循环阻塞检测
+    - 事件循环内的协程定时刷新心跳
+    - 独立线程检查心跳，超过阈值未刷新即视为阻塞，记录事件循环线程当前的调用栈
+    - 每次阻塞只告警一次，恢复后记录总阻塞时长
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.interval = max(0.05, threshold / 4)
+        self._heartbeat = 0.0
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """在事件循环中调用"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch, name="portrayal-loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"事件循环阻塞检测已开启，阈值 {self.threshold * 1000:.0f}ms")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, self.interval * 2)
+            self._thread = None
+
+    async def _beat(self) -> None:
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self) -> None:
+        reported_beat: float | None = None
+
+        while not self._stop.wait(self.interval):
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat - self.interval
+
+            if stalled < self.threshold:
+                if reported_beat is not None and beat != reported_beat:
+                    logger.warning(
+                        f"事件循环已恢复，本次阻塞约 {(beat - reported_beat) * 1000:.0f}ms"
+                    )
+                    reported_beat = None
+                continue
+
+            if reported_beat == beat:
+                continue
+            reported_beat = beat
+
+            frame = sys._current_frames().get(self._loop_thread_id)  # type: ignore[arg-type]
+            stack = "".join(traceback.format_stack(frame)) if frame else "（无法获取）"
+            logger.warning(
+                f"事件循环已阻塞 {stalled * 1000:.0f}ms，事件循环线程当前调用栈：\n{stack}"
+            )
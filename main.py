@@ -1,3 +1,4 @@
+import asyncio
 import json
 import time
 from datetime import datetime
@@ -13,53 +14,122 @@ from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
 from .core.config import PluginConfig
 from .core.message import MessageManager
 from .core.profile_service import UserProfileService
-from .core.llm import LLMService
+from .core.llm import LLMCallError, LLMService
 from .core.entry import EntryService
+from .core.prewarm import PrewarmScheduler
+from .core.profiler import ProfileCapture, ProfileRun
+from .core.storage import LockTimeoutError, create_storage
+from .core.usage import UsageService
+from .core.watchdog import LoopWatchdog
 
 class PortrayalPlugin(Star):
+    # 等待同一群友的分析锁的最长时间(秒)
+    ANALYZE_LOCK_WAIT = 3
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
+        self._created_at = time.perf_counter()
         self.cfg = PluginConfig(config, context)
-        self.msg = MessageManager(self.cfg)
+        self.storage = create_storage(self.cfg)
+        self.msg = MessageManager(self.cfg, self.storage)
         self.profile_service = UserProfileService()
         self.entry_service = EntryService(self.cfg)
         self.llm = LLMService(context, self.cfg)
+        self.usage = UsageService(self.cfg, self.storage)
+        self.prewarm = PrewarmScheduler(self.cfg, self.storage, self.msg)
         self.style = None
+        self.style_ready = asyncio.Event()
+        self.history_migrated = asyncio.Event()
+        self._warmup_task: asyncio.Task | None = None
         self.history_file = self.cfg.data_dir / "analysis_history.json"
+        self.watchdog: LoopWatchdog | None = None
+        self.profiler = ProfileCapture(
+            self.cfg.data_dir / "profiles", self.cfg.debug.profile_keep_count
+        )
 
     async def initialize(self):
-        """加载插件时调用"""
+        """
+        加载插件时调用
+        只做必要的注册，样式加载、内置提示词合并等耗时工作交给后台预热
+        """
+        if self.cfg.debug.loop_watchdog:
+            self.watchdog = LoopWatchdog(self.cfg.debug.loop_lag_threshold_ms / 1000)
+            self.watchdog.start()
+        self._warmup_task = asyncio.create_task(self._warmup())
+        self.prewarm.start()
+        logger.info(
+            f"画像插件启动耗时 {(time.perf_counter() - self._created_at) * 1000:.0f}ms，"
+            f"后台预热中"
+        )
+
+    async def _warmup(self):
+        """后台预热：旧数据迁移、内置提示词、渲染样式与字体/图片资源"""
+        started = time.perf_counter()
+        # 迁移最先执行，冷却检查会等它完成，不必排在样式加载之后
+        try:
+            await self._migrate_history()
+        finally:
+            self.history_migrated.set()
+        await self.entry_service.warmup()
+        await self._load_style()
+        logger.info(f"画像插件预热完成，耗时 {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    async def _load_style(self):
+        """加载 pillowmd 样式，并渲染一次短文本以预加载字体和图片素材"""
         try:
             import pillowmd
 
-            self.style = pillowmd.LoadMarkdownStyles(self.cfg.style_dir)
+            style = await asyncio.to_thread(
+                pillowmd.LoadMarkdownStyles, self.cfg.style_dir
+            )
+            await style.AioRender(text="# 预热", useImageUrl=True)
+            self.style = style
         except Exception as e:
             logger.error(f"无法加载pillowmd样式：{e}")
+        finally:
+            self.style_ready.set()
 
     async def terminate(self):
+        if self._warmup_task and not self._warmup_task.done():
+            self._warmup_task.cancel()
+        await self.prewarm.stop()
         self.msg.clear_cache()
+        await self.storage.close()
+        if self.watchdog:
+            await self.watchdog.stop()
 
-    def _get_history(self) -> dict:
-        """读取历史记录"""
-        if not self.history_file.exists():
-            return {}
-        try:
-            with open(self.history_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"读取画像历史记录失败: {e}")
-            return {}
+    def _read_legacy_history(self) -> dict[str, str]:
+        with open(self.history_file, "r", encoding="utf-8") as f:
+            return json.load(f)
 
-    def _save_history(self, data: dict):
-        """保存历史记录"""
+    async def _migrate_history(self):
+        """把旧版 analysis_history.json 中的冷却记录迁移到存储后端"""
+        if not self.history_file.exists():
+            return
         try:
-            self.cfg.data_dir.mkdir(parents=True, exist_ok=True)
-            with open(self.history_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            history = await asyncio.to_thread(self._read_legacy_history)
+            cooldown_seconds = self.cfg.message.analysis_cooldown * 24 * 60 * 60
+            now = time.time()
+            migrated = 0
+            for target_id, last_time_str in history.items():
+                dt_obj = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
+                # 只迁移仍在冷却中的记录，过期时间与 _update_cooldown 一致
+                remaining = dt_obj.timestamp() + cooldown_seconds - now
+                if remaining <= 0:
+                    continue
+                await self.storage.set(
+                    f"cooldown:{target_id}", dt_obj.timestamp(), ttl=remaining
+                )
+                migrated += 1
+            self.history_file.rename(self.history_file.with_suffix(".json.migrated"))
+            logger.info(
+                f"已迁移{migrated}条仍在冷却中的画像历史记录到存储后端"
+                f"（共{len(history)}条）"
+            )
         except Exception as e:
-            logger.error(f"保存画像历史记录失败: {e}")
+            logger.error(f"迁移画像历史记录失败: {e}")
 
-    def _check_cooldown(self, target_id: str) -> tuple[bool, str]:
+    async def _check_cooldown(self, target_id: str) -> tuple[bool, str]:
         """
         检查用户是否在冷却中
         配置单位：天
@@ -70,17 +140,11 @@ class PortrayalPlugin(Star):
             return True, ""
         
         cooldown_seconds = cooldown_days * 24 * 60 * 60
-        
-        history = self._get_history()
-        last_time_str = history.get(str(target_id))
-        
-        if not last_time_str:
-            return True, ""
 
-        try:
-            dt_obj = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-            last_timestamp = dt_obj.timestamp()
-        except ValueError:
+        # 旧版冷却记录迁移完成前，存储后端里的冷却记录不完整
+        await self.history_migrated.wait()
+        last_timestamp = await self.storage.get(f"cooldown:{target_id}")
+        if not last_timestamp:
             return True, ""
 
         current_time = time.time()
@@ -106,14 +170,17 @@ class PortrayalPlugin(Star):
             
         return True, ""
 
-    def _update_cooldown(self, target_id: str):
+    async def _update_cooldown(self, target_id: str):
         """更新用户的上次分析时间"""
-        if self.cfg.message.analysis_cooldown <= 0:
+        cooldown_days = self.cfg.message.analysis_cooldown
+        if cooldown_days <= 0:
             return
-            
-        history = self._get_history()
-        history[str(target_id)] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self._save_history(history)
+
+        await self.storage.set(
+            f"cooldown:{target_id}",
+            time.time(),
+            ttl=cooldown_days * 24 * 60 * 60,
+        )
 
     def _get_target_id(self, event: AiocqhttpMessageEvent) -> str | None:
         """
@@ -140,9 +207,10 @@ class PortrayalPlugin(Star):
         return None
 
     async def send(self, event: AiocqhttpMessageEvent, message: str):
+        await self.style_ready.wait()
         if self.style:
             img = await self.style.AioRender(text=message, useImageUrl=True)
-            img_path = img.Save(self.cfg.cache_dir)
+            img_path = await asyncio.to_thread(img.Save, self.cfg.cache_dir)
             await event.send(event.image_result(str(img_path))) 
         else:
             await event.send(event.plain_result(message)) 
@@ -156,6 +224,10 @@ class PortrayalPlugin(Star):
         """
         cmd = event.message_str.partition(" ")[0]
         prompt = self.entry_service.match_prompt_by_cmd(cmd)
+        if not prompt and await self.entry_service.is_pending(cmd):
+            # 内置提示词命令尚未合并完成，等待预热后再匹配一次
+            await self.entry_service.ready.wait()
+            prompt = self.entry_service.match_prompt_by_cmd(cmd)
         if not prompt:
             return
             
@@ -166,50 +238,168 @@ class PortrayalPlugin(Star):
         if not target_id:
             target_id = event.get_sender_id()
 
-        # ---------- 检查冷却 ----------
-        can_proceed, msg = self._check_cooldown(target_id)
-        if not can_proceed:
-            yield event.plain_result(msg)
-            return
+        group_id = event.get_group_id()
+        await self.prewarm.record_demand(event.bot, group_id)
+        async with self.profiler.capture(group_id, target_id) as run:
+            async for result in self._run_portrayal(event, cmd, prompt, target_id, run):
+                yield result
+        logger.debug(f"画像耗时（群{group_id}/{target_id}）：{run.summary()}")
+
+    async def _run_portrayal(
+        self,
+        event: AiocqhttpMessageEvent,
+        cmd: str,
+        prompt: str,
+        target_id: str,
+        run: ProfileRun,
+    ):
+        """画像流程：缓存 → 冷却 → 拉取消息 → LLM → 发送"""
+        # 同一群友同一时间只允许一个实例分析（跨节点 single-flight）
+        # 只短暂等待，拿不到锁说明其他命令正在分析，直接提示而不是排队
+        try:
+            async with self.storage.lock(
+                f"analyze:{target_id}",
+                ttl=self.cfg.storage.lock_timeout,
+                timeout=self.ANALYZE_LOCK_WAIT,
+            ):
+                # ---------- 查询轮数 ----------
+                end_param = event.message_str.split(" ")[-1]
+                query_rounds = self.cfg.message.get_query_rounds(end_param)
 
-        # ---------- 用户画像 ----------
-        profile = await self.profile_service.get_profile(event, target_id)
+                # ---------- 画像缓存 ----------
+                group_id = event.get_group_id()
+                cache_key = f"portrait:{group_id}:{target_id}:{cmd}:{query_rounds}"
+                content = await self.storage.get(cache_key)
+                if content:
+                    logger.info(f"命中画像缓存：{cache_key}")
+                    with run.stage("render"):
+                        await self.send(event, content)
+                    return
 
-        # ---------- 查询轮数 ----------
-        end_param = event.message_str.split(" ")[-1]
-        query_rounds = self.cfg.message.get_query_rounds(end_param)
+                # ---------- 检查冷却 ----------
+                can_proceed, msg = await self._check_cooldown(target_id)
+                if not can_proceed:
+                    yield event.plain_result(msg)
+                    return
 
-        yield event.plain_result(
-            f"正在发起{query_rounds}轮查询来获取{profile.nickname}的聊天记录(含上下文)..."
-        )
+                # ---------- 预算 ----------
+                plan = await self.usage.plan(
+                    group_id, query_rounds, self.cfg.message.max_msg_count
+                )
+                if not plan.allowed:
+                    yield event.plain_result(plan.reason)
+                    return
+                if plan.shrunk:
+                    logger.info(
+                        f"群{group_id}预算不足，查询轮数 {query_rounds}→{plan.rounds}，"
+                        f"片段上限 {self.cfg.message.max_msg_count}→{plan.max_count}"
+                    )
+                    query_rounds = plan.rounds
+                    # 缩减后的画像只覆盖较少的记录，不能冒充完整轮数的缓存
+                    cache_key = f"portrait:{group_id}:{target_id}:{cmd}:{query_rounds}"
 
-        # ---------- 消息 ----------
-        result = await self.msg.get_user_texts(
-            event,
-            profile.user_id,
-            max_rounds=query_rounds,
-        )
+                try:
+                    # ---------- 用户画像 ----------
+                    with run.stage("profile"):
+                        profile = await self.profile_service.get_profile(event, target_id)
 
-        if result.is_empty:
-            yield event.plain_result("没有查询到该群友的任何消息")
-            return
+                    yield event.plain_result(
+                        f"正在发起{query_rounds}轮查询来获取{profile.nickname}的聊天记录(含上下文)..."
+                    )
 
-        self._update_cooldown(target_id)
+                    # ---------- 消息 ----------
+                    try:
+                        result = await self.msg.get_user_texts(
+                            event,
+                            profile.user_id,
+                            max_rounds=query_rounds,
+                            max_count=plan.max_count,
+                            run=run,
+                        )
+                    except LockTimeoutError:
+                        yield event.plain_result("本群的聊天记录正在被查询，请稍后再试")
+                        return
 
-        yield event.plain_result(
-            f"已查找到{result.scanned_messages}条群消息，提取到"
-            f"{result.count}组{profile.nickname}的对话片段，正在分析..."
-        )
+                    if result.is_empty:
+                        yield event.plain_result("没有查询到该群友的任何消息")
+                        return
 
-        # ---------- LLM ----------
-        try:
-            content = await self.llm.generate_portrait(result.texts, profile, prompt)
-        except Exception as e:
-            logger.error(f"LLM 调用失败：{e}")
-            yield event.plain_result(f"分析失败：{e}")
+                    await self._update_cooldown(target_id)
+
+                    yield event.plain_result(
+                        f"已查找到{result.scanned_messages}条群消息，提取到"
+                        f"{result.count}组{profile.nickname}的对话片段，正在分析..."
+                    )
+
+                    # ---------- LLM ----------
+                    try:
+                        with run.stage("prompt"):
+                            system_prompt, user_prompt = self.llm.build_prompts(
+                                result.texts, profile, prompt
+                            )
+                        with run.stage("llm"):
+                            content, usage = await self.llm.generate_portrait(
+                                system_prompt, user_prompt, profile
+                            )
+                    except Exception as e:
+                        logger.error(f"LLM 调用失败：{e}")
+                        if isinstance(e, LLMCallError):
+                            await self.usage.record(
+                                group_id,
+                                event.get_sender_id(),
+                                target_id,
+                                e.usage,
+                                result.count,
+                                plan.reservation,
+                            )
+                        yield event.plain_result(f"分析失败：{e}")
+                        return
+
+                    await self.usage.record(
+                        group_id,
+                        event.get_sender_id(),
+                        target_id,
+                        usage,
+                        result.count,
+                        plan.reservation,
+                    )
+
+                    await self.storage.set(cache_key, content, ttl=self.cfg.message.cache_ttl)
+                finally:
+                    # 没有走到 LLM 调用时释放预留额度
+                    await self.usage.release(group_id, plan.reservation)
+        except LockTimeoutError:
+            yield event.plain_result("该群友正在被分析，请稍后再试")
+            return
 
         # ---------- 发送 ----------
-        await self.send(event, content)
+        with run.stage("render"):
+            await self.send(event, content)
+
+    @filter.event_message_type(filter.EventMessageType.GROUP_MESSAGE)
+    @filter.command("画像用量")
+    async def get_usage(self, event: AiocqhttpMessageEvent):
+        """
+        画像用量：查看本群今日 / 本月的 LLM 用量与预算
+        """
+        text = await self.usage.report(event.get_group_id())
+        await self.send(event, text)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("画像采样")
+    async def arm_profiling(
+        self,
+        event: AiocqhttpMessageEvent,
+        count: int = 1,
+        group_id: str | None = None,
+    ):
+        """
+        画像采样 <次数> <群号>：对接下来几次画像命令做性能采样，次数为0则取消
+        """
+        self.profiler.arm(count, group_id)
+        yield event.plain_result(
+            f"{self.profiler.status()}\n结果目录：{self.profiler.output_dir}"
+        )
 
     @filter.command("画像提示词", alias={"查看画像提示词"})
     async def get_prompt(
@@ -220,6 +410,7 @@ class PortrayalPlugin(Star):
         """
         查看画像提示词 <命令>
         """
+        await self.entry_service.ready.wait()
         text = self.entry_service.view_entry(command)
         if not text:
             yield event.plain_result(f"提示词【{command}】不存在")
@@ -0,0 +1,529 @@
+"""
+画像插件并发压测 / 长稳测试脚本
+
+用本地假协议端(OneBot)和假 LLM 驱动 PortrayalPlugin.get_portrayal，
+模拟多个群同时发起画像命令，统计端到端延迟分位数、吞吐、事件循环卡顿和内存峰值。
+需要在装有 AstrBot 的环境中运行：
+
+    python tools/load_harness.py --groups 20 --concurrency 10 --duration 60 \\
+        --onebot-latency 0.05 --llm-latency 1.5 --error-rate 0.02
+
+可用 --snapshot 指定一份历史快照，用真实群聊数据代替合成消息。
+可用 --no-cache 关闭画像缓存和历史分页缓存，让每条命令都走完整流程；
+延迟分位数只统计完整流程，命中缓存、冷却 / 预算 / 并发拒绝分别单独计数。
+可用 --storage fakeredis 让 RedisStorage 跑在进程内的 fakeredis 上（需要 pip install "fakeredis[lua]" "redis>=5"）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import importlib
+import json
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PLUGIN_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PLUGIN_DIR.parent))
+
+from astrbot.core.message.components import At  # noqa: E402
+
+plugin_main = importlib.import_module(f"{PLUGIN_DIR.name}.main")
+snapshot = importlib.import_module(f"{PLUGIN_DIR.name}.core.snapshot")
+storage = importlib.import_module(f"{PLUGIN_DIR.name}.core.storage")
+
+BOT_ID = "10000"
+
+
+# =========================
+# fakes
+# =========================
+
+
+class FaultInjector:
+    """按配置注入延迟和随机错误"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, name: str):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.name = name
+
+    async def __call__(self) -> None:
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"[{self.name}] 注入的随机错误")
+
+
+class FakeHistory:
+    """单个群的历史消息，按 message_seq 倒序分页"""
+
+    def __init__(self, messages: list[dict[str, Any]]):
+        self.messages = sorted(messages, key=lambda m: int(m["message_seq"]))
+
+    @classmethod
+    def synthetic(cls, group_id: int, size: int, members: int) -> "FakeHistory":
+        rng = random.Random(group_id)
+        now = int(time.time())
+        messages = []
+        for seq in range(1, size + 1):
+            user_id = group_id * 1000 + rng.randrange(members)
+            length = rng.randint(4, 40)
+            text = "".join(rng.choice("今天群里好热闹我觉得这个不太行哈哈") for _ in range(length))
+            messages.append(
+                {
+                    "message_id": group_id * 1_000_000 + seq,
+                    "message_seq": seq,
+                    "time": now - (size - seq) * 30,
+                    "sender": {"user_id": user_id, "nickname": f"群友{user_id}"},
+                    "message": [{"type": "text", "data": {"text": text}}],
+                }
+            )
+        return cls(messages)
+
+    def page(self, message_seq: int, count: int) -> list[dict[str, Any]]:
+        if message_seq:
+            older = [m for m in self.messages if int(m["message_seq"]) <= message_seq]
+        else:
+            older = self.messages
+        return older[-count:]
+
+
+class FakeApi:
+    def __init__(self, histories: dict[int, FakeHistory], fault: FaultInjector):
+        self.histories = histories
+        self.fault = fault
+        self.calls = 0
+
+    async def call_action(self, action: str, **params: Any) -> dict[str, Any]:
+        assert action == "get_group_msg_history", action
+        self.calls += 1
+        await self.fault()
+        history = self.histories[int(params["group_id"])]
+        return {"messages": history.page(int(params["message_seq"]), int(params["count"]))}
+
+
+class FakeBot:
+    def __init__(self, api: FakeApi):
+        self.api = api
+
+    async def get_group_member_info(self, group_id: int, user_id: int) -> dict[str, Any]:
+        return {"card": "", "nickname": f"群友{user_id}", "sex": random.choice(["male", "female"])}
+
+
+class FakeEvent:
+    """get_portrayal 用到的 AiocqhttpMessageEvent 接口子集"""
+
+    def __init__(self, bot: FakeBot, group_id: int, sender_id: int, target_id: int, rounds: int):
+        self.bot = bot
+        self.group_id = group_id
+        self.sender_id = sender_id
+        self.target_id = target_id
+        self.message_str = f"画像 @{target_id} {rounds}"
+        self.sent: list[Any] = []
+
+    def get_group_id(self) -> str:
+        return str(self.group_id)
+
+    def get_sender_id(self) -> str:
+        return str(self.sender_id)
+
+    def get_self_id(self) -> str:
+        return BOT_ID
+
+    def get_messages(self) -> list[Any]:
+        return [At(qq=self.target_id)]
+
+    def plain_result(self, text: str) -> str:
+        return text
+
+    def image_result(self, path: str) -> str:
+        return path
+
+    async def send(self, result: Any) -> None:
+        self.sent.append(result)
+
+    def stop_event(self) -> None:
+        pass
+
+
+@dataclass
+class FakeLLMResponse:
+    completion_text: str
+
+
+class FakeProvider:
+    def __init__(self, fault: FaultInjector):
+        self.fault = fault
+        self.calls = 0
+
+    async def text_chat(self, *, system_prompt: str, prompt: str, **kwargs: Any) -> FakeLLMResponse:
+        self.calls += 1
+        await self.fault()
+        return FakeLLMResponse(f"画像结果（prompt {len(prompt)} 字）")
+
+
+class FakeContext:
+    def get_provider_by_id(self, provider_id: str) -> None:
+        return None
+
+    def get_using_provider(self) -> None:
+        return None
+
+
+# =========================
+# metrics
+# =========================
+
+
+# 插件拒绝执行画像时回复的文本前缀
+REFUSALS = {
+    "cooldown": ("该群友在",),
+    "budget": ("本群的画像预算已用完", "本群剩余画像预算仅", "画像预算检查失败"),
+    "busy": ("该群友正在被分析", "本群的聊天记录正在被查询"),
+}
+
+
+@dataclass
+class Metrics:
+    # 只统计完整走完拉取消息 → LLM → 发送的命令
+    latencies: list[float] = field(default_factory=list)
+    cache_hit_latencies: list[float] = field(default_factory=list)
+    cache_hits: int = 0
+    refusals: dict[str, int] = field(default_factory=lambda: dict.fromkeys(REFUSALS, 0))
+    empty: int = 0
+    errors: int = 0
+    loop_lags: list[float] = field(default_factory=list)
+
+    def record(self, results: list[Any], sent: list[Any], latency: float) -> None:
+        """按插件的回复给一次命令归类"""
+        texts = [str(r) for r in results]
+        if any(t.startswith("分析失败") for t in texts):
+            self.errors += 1
+            return
+        for reason, prefixes in REFUSALS.items():
+            if any(t.startswith(prefixes) for t in texts):
+                self.refusals[reason] += 1
+                return
+        if any(t.startswith("没有查询到") for t in texts):
+            self.empty += 1
+        elif not texts and sent:
+            # 命中画像缓存时不会有进度回复，直接发送结果
+            self.cache_hits += 1
+            self.cache_hit_latencies.append(latency)
+        else:
+            self.latencies.append(latency)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+async def sample_loop_lag(metrics: Metrics, stop: asyncio.Event, interval: float = 0.05) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.loop_lags.append(max(0.0, loop.time() - start - interval))
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+# =========================
+# runner
+# =========================
+
+
+class UncachedStorage(storage.StorageBackend):
+    """丢弃画像缓存与历史分页缓存的存储包装，让每条命令都走完整流程"""
+
+    CACHE_PREFIXES = ("portrait:", "page:")
+
+    def __init__(self, inner: Any):
+        super().__init__()
+        self.inner = inner
+
+    def _is_cache(self, key: str) -> bool:
+        return key.startswith(self.CACHE_PREFIXES)
+
+    async def get(self, key: str) -> Any | None:
+        return None if self._is_cache(key) else await self.inner.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        if not self._is_cache(key):
+            await self.inner.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.inner.delete(key)
+
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        return await self.inner._acquire(key, token, ttl)
+
+    async def _release(self, key: str, token: str) -> None:
+        await self.inner._release(key, token)
+
+    async def _renew(self, key: str, token: str, ttl: float) -> bool:
+        return await self.inner._renew(key, token, ttl)
+
+    def lock(self, key: str, **kwargs: Any) -> Any:
+        return self.inner.lock(key, **kwargs)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+def patch_storage(args: argparse.Namespace) -> None:
+    """按参数替换插件创建存储后端的方式"""
+    create = storage.create_storage
+    if args.storage == "fakeredis":
+        try:
+            from fakeredis import aioredis as fake_aioredis
+        except ImportError:
+            raise SystemExit('--storage fakeredis 需要先安装 fakeredis：pip install "fakeredis[lua]"')
+        client = fake_aioredis.FakeRedis(decode_responses=True)
+
+        def create(cfg: Any) -> Any:
+            # RedisStorage 跑在进程内的 fakeredis 上
+            return storage.RedisStorage("", cfg.storage.key_prefix, client=client)
+
+    if args.no_cache:
+        inner_create = create
+
+        def create(cfg: Any) -> Any:
+            return UncachedStorage(inner_create(cfg))
+
+    plugin_main.create_storage = create
+
+
+def schema_defaults() -> dict[str, Any]:
+    """按 _conf_schema.json 生成默认配置，与 AstrBot 加载插件时填充的默认值一致"""
+    schema = json.loads((PLUGIN_DIR / "_conf_schema.json").read_text(encoding="utf-8"))
+
+    def default(item: dict[str, Any]) -> Any:
+        if item.get("type") == "object":
+            return {k: default(v) for k, v in item.get("items", {}).items()}
+        if item.get("type") == "template_list":
+            return item.get("default", [])
+        return item.get("default")
+
+    return {k: default(v) for k, v in schema.items()}
+
+
+def build_plugin(args: argparse.Namespace, provider: FakeProvider) -> Any:
+    patch_storage(args)
+    # 新增的配置段即使这里没有列出，也会带上默认值
+    config = schema_defaults()
+    overrides = {
+        "llm": {"provider_id": "", "retry_times": 0},
+        "message": {
+            "default_query_rounds": args.rounds,
+            "max_msg_count": args.max_msg_count,
+            "cache_ttl_min": args.cache_ttl_min,
+            "analysis_cooldown": 0,
+            "context_num": args.context_num,
+            "allow_analyze_self": False,
+            "resume_scan": not args.no_resume,
+        },
+        "storage": {
+            "backend": "memory",
+            "redis_url": "",
+            "key_prefix": "portrayal:",
+            "lock_timeout": 600,
+        },
+        "snapshot": {"auto_export": False, "replay": False, "compress": True, "keep_count": 1},
+        "budget": {"daily_tokens": 0, "monthly_tokens": 0},
+        "prewarm": {
+            "enable": False,
+            "windows": "",
+            "rounds": 1,
+            "max_groups": 1,
+            "min_demand": 1,
+            "rate_per_min": 1,
+            "keep_hours": 1,
+        },
+        "debug": {"loop_watchdog": False, "loop_lag_threshold_ms": 200, "profile_keep_count": 1},
+        "load_builtin_prompt": False,
+        "entry_storage": [{"command": "画像", "content": "请分析{nickname}，{gender}的性格"}],
+    }
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    plugin = plugin_main.PortrayalPlugin(FakeContext(), config)
+    plugin.llm._get_provider = lambda: provider
+    return plugin
+
+
+def build_histories(args: argparse.Namespace) -> tuple[dict[int, FakeHistory], dict[int, list[int]]]:
+    histories: dict[int, FakeHistory] = {}
+    if args.snapshot:
+        messages = list(snapshot.iter_snapshot(Path(args.snapshot)))
+        for m in messages:
+            m.setdefault("message_seq", m.get("message_id"))
+        for g in range(args.groups):
+            histories[100000 + g] = FakeHistory(messages)
+    else:
+        for g in range(args.groups):
+            histories[100000 + g] = FakeHistory.synthetic(100000 + g, args.history_size, args.members)
+
+    targets = {
+        gid: sorted({int(m["sender"]["user_id"]) for m in h.messages})
+        for gid, h in histories.items()
+    }
+    return histories, targets
+
+
+async def worker(
+    plugin: Any,
+    bot: FakeBot,
+    targets: dict[int, list[int]],
+    args: argparse.Namespace,
+    metrics: Metrics,
+    deadline: float,
+) -> None:
+    group_ids = list(targets)
+    while time.monotonic() < deadline:
+        group_id = random.choice(group_ids)
+        target_id = random.choice(targets[group_id])
+        event = FakeEvent(bot, group_id, random.choice(targets[group_id]), target_id, args.rounds)
+
+        start = time.perf_counter()
+        try:
+            results = [r async for r in plugin.get_portrayal(event)]
+            metrics.record(results, event.sent, time.perf_counter() - start)
+        except Exception as e:
+            metrics.errors += 1
+            if args.verbose:
+                print(f"请求失败：{e!r}")
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    histories, targets = build_histories(args)
+    api = FakeApi(histories, FaultInjector(args.onebot_latency, args.jitter, args.error_rate, "onebot"))
+    provider = FakeProvider(FaultInjector(args.llm_latency, args.jitter, args.error_rate, "llm"))
+    plugin = build_plugin(args, provider)
+    if args.render:
+        await plugin.initialize()
+        await plugin._warmup_task
+    else:
+        plugin.entry_service.builtin_loaded.set()
+        plugin.entry_service.ready.set()
+        plugin.style_ready.set()
+        plugin.history_migrated.set()
+    bot = FakeBot(api)
+
+    metrics = Metrics()
+    stop = asyncio.Event()
+    tracemalloc.start()
+    lag_task = asyncio.create_task(sample_loop_lag(metrics, stop))
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(
+        *(worker(plugin, bot, targets, args, metrics, deadline) for _ in range(args.concurrency))
+    )
+    elapsed = time.monotonic() - started
+
+    stop.set()
+    await lag_task
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await plugin.terminate()
+
+    lat_ms = [x * 1000 for x in metrics.latencies]
+    hit_ms = [x * 1000 for x in metrics.cache_hit_latencies]
+    lag_ms = [x * 1000 for x in metrics.loop_lags]
+    return {
+        "duration_s": round(elapsed, 2),
+        "completed": len(lat_ms),
+        "cache_hits": metrics.cache_hits,
+        "refused": metrics.refusals,
+        "empty": metrics.empty,
+        "errors": metrics.errors,
+        "throughput_rps": round(len(lat_ms) / elapsed, 3) if elapsed else 0,
+        "latency_ms": {
+            "p50": round(percentile(lat_ms, 50), 1),
+            "p95": round(percentile(lat_ms, 95), 1),
+            "p99": round(percentile(lat_ms, 99), 1),
+            "max": round(max(lat_ms, default=0), 1),
+        },
+        "cache_hit_latency_ms": {
+            "p50": round(percentile(hit_ms, 50), 1),
+            "p99": round(percentile(hit_ms, 99), 1),
+        },
+        "loop_lag_ms": {
+            "p99": round(percentile(lag_ms, 99), 1),
+            "max": round(max(lag_ms, default=0), 1),
+        },
+        "onebot_calls": api.calls,
+        "llm_calls": provider.calls,
+        "peak_rss_mb": peak_rss_mb(),
+        "tracemalloc_peak_mb": round(traced_peak / 1024 / 1024, 2),
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="画像插件并发压测")
+    p.add_argument("--groups", type=int, default=10, help="模拟的群数量")
+    p.add_argument("--members", type=int, default=50, help="每个群的活跃成员数（合成数据）")
+    p.add_argument("--history-size", type=int, default=5000, help="每个群的历史消息数（合成数据）")
+    p.add_argument("--snapshot", help="使用历史快照文件代替合成数据")
+    p.add_argument("--concurrency", type=int, default=8, help="并发发起命令的协程数")
+    p.add_argument("--duration", type=float, default=30, help="压测持续时间(秒)")
+    p.add_argument("--rounds", type=int, default=10, help="每次命令的查询轮数")
+    p.add_argument("--max-msg-count", type=int, default=500)
+    p.add_argument("--context-num", type=int, default=2)
+    p.add_argument("--cache-ttl-min", type=int, default=1)
+    p.add_argument("--no-resume", action="store_true", help="关闭断点续查")
+    p.add_argument("--no-cache", action="store_true", help="关闭画像缓存和历史分页缓存")
+    p.add_argument(
+        "--storage",
+        choices=["memory", "fakeredis"],
+        default="memory",
+        help="存储后端：进程内存，或跑在 fakeredis 上的 RedisStorage",
+    )
+    p.add_argument("--onebot-latency", type=float, default=0.05, help="协议端每次调用的基础延迟(秒)")
+    p.add_argument("--llm-latency", type=float, default=1.0, help="LLM 每次调用的基础延迟(秒)")
+    p.add_argument("--jitter", type=float, default=0.05, help="随机附加延迟上限(秒)")
+    p.add_argument("--error-rate", type=float, default=0.0, help="协议端 / LLM 随机错误概率")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", help="把结果写入 JSON 文件")
+    p.add_argument("--render", action="store_true", help="完整初始化插件并用 pillowmd 渲染图片")
+    p.add_argument("--verbose", action="store_true")
+    return p.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()